@@ -0,0 +1,150 @@
+# headless runner for pipeline files (xml or json) saved by main.py
+#
+#   python batch.py test.xml images/ -o out/ -r timing.csv
+#   python batch.py test.xml movie.avi -j 4
+#   python batch.py test.xml movie.avi -d detections.csv
+#
+# every worker process builds its own stage chain from the file, frames are
+# spread across the workers and written in input order.
+
+import os
+import sys
+import argparse
+import multiprocessing
+import cv2
+import numpy as np
+
+import imageprocess as ip
+import pipeline
+import project
+
+image_exts = ['.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff']
+
+worker_pipeline = None
+
+
+def init_worker(filename):
+    global worker_pipeline
+    # every frame needs its own OCR result here
+    ip.Pyocr.workers = 0
+    worker_pipeline = pipeline.Pipeline()
+    stages = ip.load_stages(project.load(filename))
+    for (index, stage) in enumerate(stages):
+        worker_pipeline.insert(index, stage)
+
+
+def process_frame(args):
+    name, image, output_index = args
+    if image is None:  # file name only, read it in the worker
+        image = cv2.imread(name)
+    if image is None:
+        return (name, None, [], [])
+    worker_pipeline.set_frame(ip.ImageObj(image, ip.CvtColor.Codes.BGR))
+    job = worker_pipeline.prepare()
+    job.run()
+    worker_pipeline.commit(job)
+    obj = job.results[output_index]
+    if obj is None:
+        return (name, None, job.times, [])
+    # a stage after a region of interest works in its coordinates
+    return (name, ip.to_bgr(obj), job.times, ip.to_frame_detections(obj))
+
+
+def read_frames(source, output_index):
+    if os.path.isdir(source):
+        for filename in sorted(os.listdir(source)):
+            if os.path.splitext(filename)[1].lower() in image_exts:
+                yield (os.path.join(source, filename), None, output_index)
+    else:
+        capture = cv2.VideoCapture(source)
+        count = 0
+        while True:
+            success, image = capture.read()
+            if not success:
+                break
+            yield ('%06d' % count, image, output_index)
+            count += 1
+        capture.release()
+
+
+def write_report(filename, names, rows):
+    with open(filename, 'w') as file:
+        file.write(','.join(['frame'] + names) + '\n')
+        for (frame_name, times) in rows:
+            cols = ['' if t is None else '%.3f' % (t*1000) for t in times]
+            file.write(','.join([frame_name] + cols) + '\n')
+
+
+def write_detections(file, frame_name, detections):
+    for (x, y, w, h, label) in detections:
+        if isinstance(label, unicode):
+            label = label.encode('utf-8')
+        label = '' if label is None else str(label).replace(',', ' ')
+        file.write('%s,%d,%d,%d,%d,%s\n' % (frame_name, x, y, w, h, label))
+
+
+def print_summary(names, rows):
+    print 'stage, mean [ms], max [ms]'
+    for (index, name) in enumerate(names):
+        stage_times = [row_times[index] for (_, row_times) in rows
+                       if index < len(row_times)
+                       and row_times[index] is not None]
+        if len(stage_times) == 0:
+            continue
+        print '%s, %.3f, %.3f' % (name, np.mean(stage_times)*1000,
+                                  np.max(stage_times)*1000)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='run pipeline xml headless')
+    parser.add_argument('pipeline', help='pipeline file saved by main.py')
+    parser.add_argument('source', help='image directory or video file')
+    parser.add_argument('-o', '--output', default='output',
+                        help='output directory')
+    parser.add_argument('-s', '--stage', type=int, default=-1,
+                        help='index of stage to write (default: last)')
+    parser.add_argument('-r', '--report', default=None,
+                        help='per-stage timing report (csv)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-d', '--detections', default=None,
+                        help='contours/OCR words of the stage in full '
+                        'frame coordinates (csv)')
+    args = parser.parse_args(argv)
+
+    root_top = project.load(args.pipeline)
+    names = ['%d:%s' % (index, root_module.get('name'))
+             for (index, root_module) in enumerate(root_top.findall('module'))]
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    pool = multiprocessing.Pool(args.jobs, init_worker, (args.pipeline,))
+    rows = []
+    detection_file = None
+    if args.detections is not None:
+        detection_file = open(args.detections, 'w')
+        detection_file.write('frame,x,y,width,height,label\n')
+    try:
+        for (name, image, times, detections) in pool.imap(
+                process_frame, read_frames(args.source, args.stage)):
+            frame_name = os.path.splitext(os.path.basename(name))[0]
+            rows.append((frame_name, times))
+            if detection_file is not None:
+                write_detections(detection_file, frame_name, detections)
+            if image is None:
+                print 'failed:', name
+                continue
+            cv2.imwrite(os.path.join(args.output, frame_name + '.png'), image)
+    finally:
+        pool.close()
+        pool.join()
+        if detection_file is not None:
+            detection_file.close()
+
+    if args.report is not None:
+        write_report(args.report, names, rows)
+    print_summary(names, rows)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,218 @@
+import os
+import time
+import threading
+
+import cv2
+import numpy as np
+
+# cv2.cv.CV_CAP_PROP_* of OpenCV 2.4
+CAP_PROP_POS_FRAMES = 1
+CAP_PROP_FPS = 5
+
+
+class CaptureWorker(threading.Thread):
+    # grabs frames from cv2.VideoCapture continuously on its own thread
+    #
+    # frames are decoded into a small ring of preallocated arrays. consumers
+    # always take the newest frame with latest(), which holds its slot until
+    # release() is called, so the worker never overwrites a frame in use.
+    # frames overwritten before anyone took them are counted as dropped,
+    # frames taken more than once are counted as duplicated.
+    def __init__(self, capture, size=4):
+        super(CaptureWorker, self).__init__()
+        assert(3 <= size)
+        self.daemon = True
+        self.capture = capture
+        self.size = size
+        self.ring = [None] * size
+        self.ring_ids = [0] * size
+        self.holds = [0] * size
+        self.write_index = 0
+        self.latest_index = None
+        self.latest_id = 0
+        self.taken_id = 0
+        self.captured = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.cond = threading.Condition()
+        self.quit_event = threading.Event()
+
+    def run(self):
+        while not self.quit_event.is_set():
+            with self.cond:
+                index = self.next_index()
+            if index is None:
+                # every slot is held by consumers, discard this frame
+                self.capture.grab()
+                with self.cond:
+                    self.captured += 1
+                    self.dropped += 1
+                continue
+
+            if self.ring[index] is None:
+                success, image = self.capture.read()
+            else:
+                success, image = self.capture.read(self.ring[index])
+            if not success:
+                self.quit_event.wait(0.01)
+                continue
+
+            with self.cond:
+                if self.ring[index] is None:
+                    self.preallocate(image)
+                self.ring[index] = image
+                if self.latest_id != self.taken_id:
+                    self.dropped += 1
+                self.captured += 1
+                self.latest_id += 1
+                self.ring_ids[index] = self.latest_id
+                self.latest_index = index
+                self.cond.notify_all()
+
+    def next_index(self):
+        # next slot which is neither held nor the newest frame
+        for i in range(1, self.size+1):
+            index = (self.write_index + i) % self.size
+            if self.holds[index] == 0 and index != self.latest_index:
+                self.write_index = index
+                return index
+        return None
+
+    def preallocate(self, image):
+        for index in range(self.size):
+            if self.ring[index] is None:
+                self.ring[index] = np.empty_like(image)
+
+    def quit(self):
+        self.quit_event.set()
+        with self.cond:
+            self.cond.notify_all()
+
+    def latest(self, timeout=None):
+        # returns (frame_id, image) of the newest frame, or (None, None)
+        # if no frame arrives within timeout
+        with self.cond:
+            if self.latest_index is None:
+                self.cond.wait(timeout)
+            if self.latest_index is None:
+                return (None, None)
+            index = self.latest_index
+            if self.ring_ids[index] == self.taken_id:
+                self.duplicated += 1
+            self.taken_id = self.ring_ids[index]
+            self.holds[index] += 1
+            return (self.taken_id, self.ring[index])
+
+    def retain(self, frame_id):
+        with self.cond:
+            for index in range(self.size):
+                if self.ring_ids[index] == frame_id and self.holds[index] > 0:
+                    self.holds[index] += 1
+                    return True
+            return False
+
+    def release(self, frame_id):
+        with self.cond:
+            for index in range(self.size):
+                if self.ring_ids[index] == frame_id and self.holds[index] > 0:
+                    self.holds[index] -= 1
+                    break
+
+    def get_counters(self):
+        with self.cond:
+            return (self.captured, self.dropped, self.duplicated)
+
+
+class SyntheticCapture():
+    # cv2.VideoCapture look-alike generating a moving test pattern, for
+    # stations without a camera and for benchmarks
+    def __init__(self, width=640, height=480, fps=30.0):
+        self.width = width
+        self.height = height
+        self.interval = 1.0 / fps
+        self.count = 0
+        self.next_time = time.time()
+        ramp = np.linspace(0, 255, width).astype(np.uint8)
+        self.background = np.empty((height, width, 3), np.uint8)
+        self.background[:] = ramp[np.newaxis, :, np.newaxis]
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        delay = self.next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time, time.time()) + self.interval
+        self.count += 1
+        return True
+
+    def retrieve(self, image=None):
+        if image is None or image.shape != self.background.shape:
+            image = np.empty_like(self.background)
+        np.copyto(image, self.background)
+        x = (self.count * 4) % (self.width - 100)
+        y = self.height // 2 - 50
+        cv2.rectangle(image, (x, y), (x+100, y+100), (255, 255, 255), -1)
+        cv2.putText(image, str(self.count % 10), (x+20, y+85),
+                    cv2.FONT_HERSHEY_PLAIN, 6, (0, 0, 0), 8)
+        return (True, image)
+
+    def read(self, image=None):
+        self.grab()
+        return self.retrieve(image)
+
+    def release(self):
+        pass
+
+
+class FileCapture():
+    # video file played back at its own frame rate and rewound at the end,
+    # so it can stand in for a camera
+    def __init__(self, filename):
+        self.capture = cv2.VideoCapture(filename)
+        fps = self.capture.get(CAP_PROP_FPS)
+        self.interval = 1.0 / fps if fps > 0 else 1.0 / 30
+        self.next_time = time.time()
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def wait(self):
+        delay = self.next_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_time = max(self.next_time, time.time()) + self.interval
+
+    def grab(self):
+        self.wait()
+        if self.capture.grab():
+            return True
+        self.capture.set(CAP_PROP_POS_FRAMES, 0)
+        return self.capture.grab()
+
+    def read(self, image=None):
+        self.wait()
+        success, image = self.capture.read(image)
+        if not success:
+            self.capture.set(CAP_PROP_POS_FRAMES, 0)
+            success, image = self.capture.read(image)
+        return (success, image)
+
+    def release(self):
+        self.capture.release()
+
+
+def open_source(spec):
+    # camera index ('0'), 'synthetic' or 'synthetic:WxH', or a video file
+    if spec.isdigit():
+        return cv2.VideoCapture(int(spec))
+    if spec == 'synthetic' or spec.startswith('synthetic:'):
+        size = spec.partition(':')[2]
+        if size:
+            width, height = [int(v) for v in size.split('x')]
+            return SyntheticCapture(width, height)
+        return SyntheticCapture()
+    if os.path.exists(spec):
+        return FileCapture(spec)
+    raise IOError('no such source: ' + spec)
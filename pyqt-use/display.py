@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+from PyQt5 import QtGui, QtCore
+
+import imageprocess as ip
+
+
+class ImageDisplay(QtCore.QObject):
+    # shows numpy frames in a QGraphicsPixmapItem
+    #
+    # one QImage is kept per size and format, together with a numpy view of
+    # its memory (including the padded stride), so frames are written into
+    # it in place and BGR is swapped to RGB while writing. the pixmap is
+    # only converted while the view is visible, otherwise the latest frame
+    # is kept pending until the view is shown again.
+    gray_table = [QtGui.qRgb(i, i, i) for i in range(256)]
+
+    def __init__(self, pixitem, view):
+        super(ImageDisplay, self).__init__()
+        self.pixitem = pixitem
+        self.view = view
+        self.view.installEventFilter(self)
+        self.buffers = {}
+        self.qimage = None
+        self.pending = False
+
+    def get_buffer(self, h, w, d):
+        key = (h, w, d)
+        if key not in self.buffers:
+            if d == 1:
+                qimage = QtGui.QImage(w, h, QtGui.QImage.Format_Indexed8)
+                qimage.setColorTable(self.gray_table)
+            else:
+                qimage = QtGui.QImage(w, h, QtGui.QImage.Format_RGB888)
+            ptr = qimage.bits()
+            ptr.setsize(qimage.byteCount())
+            array = np.ndarray(shape=(h, w, d), dtype=np.uint8, buffer=ptr,
+                               strides=(qimage.bytesPerLine(), d, 1))
+            self.buffers[key] = (qimage, array)
+        return self.buffers[key]
+
+    def set_image(self, obj):
+        image = obj.image
+        assert(image.dtype == np.uint8)
+        assert(2 <= len(image.shape) and len(image.shape) <= 3)
+        if len(image.shape) == 2:  # gray scale
+            h, w = image.shape
+            qimage, array = self.get_buffer(h, w, 1)
+            np.copyto(array[:, :, 0], image)
+        else:  # others
+            h, w, d = image.shape
+            assert(d == 3)
+            qimage, array = self.get_buffer(h, w, d)
+            if obj.code == ip.CvtColor.Codes.BGR:
+                np.copyto(array, image[:, :, ::-1])
+            else:
+                np.copyto(array, image)
+        self.qimage = qimage
+        self.pending = True
+        self.flush()
+
+    def is_visible(self):
+        return self.view.isVisible() and \
+            not self.view.visibleRegion().isEmpty()
+
+    def flush(self):
+        if not self.pending or not self.is_visible():
+            return
+        self.pending = False
+        self.pixitem.setPixmap(QtGui.QPixmap.fromImage(self.qimage))
+
+    def eventFilter(self, obj, event):
+        if obj is self.view and event.type() == QtCore.QEvent.Show:
+            self.flush()
+        return False
+
+
+class TileCanvas():
+    # composes the images of several sources into one BGR frame, tile by
+    # tile in rows of columns, reusing the canvas while its size stays
+    def __init__(self, tile_size, columns=2):
+        self.tile_size = tile_size  # (width, height)
+        self.columns = columns
+        self.canvas = None
+
+    def compose(self, images):
+        w, h = self.tile_size
+        columns = min(self.columns, len(images))
+        rows = (len(images) + columns - 1) // columns
+        shape = (rows * h, columns * w, 3)
+        if self.canvas is None or self.canvas.shape != shape:
+            self.canvas = np.zeros(shape, np.uint8)
+        for (i, image) in enumerate(images):
+            row, column = divmod(i, columns)
+            tile = self.canvas[row*h:(row+1)*h, column*w:(column+1)*w]
+            if image is None:
+                tile[:] = 0
+                continue
+            if image.shape[:2] != (h, w):
+                image = cv2.resize(image, (w, h),
+                                   interpolation=cv2.INTER_AREA)
+            if len(image.shape) == 2:
+                image = image[:, :, np.newaxis]
+            tile[:] = image
+        return self.canvas
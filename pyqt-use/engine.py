@@ -0,0 +1,75 @@
+import collections
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from PyQt5 import QtCore
+
+
+class ProcessingEngine(QtCore.QObject):
+    # executes pipeline jobs on a thread pool, off the Qt event loop
+    #
+    # cv2 releases the GIL, so with more than one job in flight consecutive
+    # frames are pipelined: frame N+1 runs its early stages while frame N is
+    # still in its later ones. finished jobs are committed on the GUI thread
+    # and announced by sigFinished.
+    sigFinished = QtCore.pyqtSignal(object)
+    sigJobDone = QtCore.pyqtSignal(object)
+
+    def __init__(self, pipeline, processes=2, max_jobs=2):
+        super(ProcessingEngine, self).__init__()
+        self.pipeline = pipeline
+        self.pool = ThreadPool(processes)
+        self.max_jobs = max_jobs
+        self.jobs = 0
+        self.dropped = 0
+        self.latencies = collections.deque(maxlen=30)
+        self.finish_times = collections.deque(maxlen=30)
+        # emitted from the pool thread, delivered on the GUI thread
+        self.sigJobDone.connect(self.finish)
+
+    def is_busy(self):
+        return self.jobs >= self.max_jobs
+
+    def submit(self):
+        # returns the submitted job, or None if too many jobs are in flight
+        if self.is_busy():
+            self.dropped += 1
+            return None
+        job = self.pipeline.prepare()
+        self.jobs += 1
+        self.pool.apply_async(self.run_job, (job,),
+                              callback=self.sigJobDone.emit)
+        return job
+
+    @staticmethod
+    def run_job(job):
+        try:
+            job.run()
+        except Exception:
+            traceback.print_exc()
+            job.failed = True
+        return job
+
+    def finish(self, job):
+        self.jobs -= 1
+        if not job.failed:
+            self.pipeline.commit(job)
+        now = time.time()
+        self.latencies.append(now - job.prepare_time)
+        self.finish_times.append(now)
+        self.sigFinished.emit(job)
+
+    def get_stats(self):
+        # returns (mean latency [s], throughput [frame/s])
+        if len(self.latencies) == 0:
+            return (0.0, 0.0)
+        latency = sum(self.latencies) / len(self.latencies)
+        elapsed = self.finish_times[-1] - self.finish_times[0]
+        if elapsed <= 0.0:
+            return (latency, 0.0)
+        return (latency, (len(self.finish_times)-1) / elapsed)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -1,4 +1,4 @@
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 from xml.etree import ElementTree
 import distutils.util
 
@@ -12,6 +12,7 @@ from gui import adaptive_threshold_ui
 from gui import find_contours_ui
 from gui import draw_contours_ui
 from gui import knn_number_ui
+from gui import knn_contours_ui
 from gui import pyocr_ui
 
 
@@ -44,10 +45,27 @@ class commonForm(QtWidgets.QWidget, common_ui.Ui_Form):
 
 
 class AbstractForm(QtWidgets.QWidget):
+    sigChanged = QtCore.pyqtSignal()
+
     def __init__(self):
         super(AbstractForm, self).__init__()
         self.setupUi(self)
 
+    def connect_changed(self):
+        # emit sigChanged whenever any parameter widget (also in commonForm)
+        # is edited, so that the owner can recompile the stage
+        emit = lambda *args: self.sigChanged.emit()
+        for spin_box in self.findChildren(QtWidgets.QSpinBox):
+            spin_box.valueChanged.connect(emit)
+        for combo_box in self.findChildren(QtWidgets.QComboBox):
+            combo_box.currentIndexChanged.connect(emit)
+        for check_box in self.findChildren(QtWidgets.QCheckBox):
+            check_box.toggled.connect(emit)
+
+    def set_module(self, module):
+        # forms which need the module itself override this
+        return module
+
     def get_xml_element(self):
         return None
 
@@ -75,11 +93,30 @@ class inputForm(AbstractForm, input_ui.Ui_Form):
         elem2.text = str(0)
         elem3 = ElementTree.SubElement(root, 'code')
         elem3.text = str(self.comboBox.currentText())
+        root_roi = ElementTree.SubElement(root, 'roi')
+        for tag, spin_box in self.get_roi_spin_boxes():
+            elem = ElementTree.SubElement(root_roi, tag)
+            elem.text = str(spin_box.value())
         return root
 
     def set_xml_element(self, root):
         code = ip.CvtColor.Codes[str(root.find('code').text)]
         self.comboBox.setCurrentIndex(code-1)
+        root_roi = root.find('roi')
+        if root_roi is not None:
+            self.set_roi([int(root_roi.find(tag).text)
+                          for tag, _ in self.get_roi_spin_boxes()])
+
+    def get_roi_spin_boxes(self):
+        return [('x', self.spinBoxRoiX),
+                ('y', self.spinBoxRoiY),
+                ('width', self.spinBoxRoiWidth),
+                ('height', self.spinBoxRoiHeight)]
+
+    def set_roi(self, roi):
+        # x, y, width, height, a width or height of 0 is the whole frame
+        for (_, spin_box), value in zip(self.get_roi_spin_boxes(), roi):
+            spin_box.setValue(value)
 
 
 class CannyForm(AbstractForm, canny_ui.Ui_Form):
@@ -191,7 +228,7 @@ class adaptiveThresholdForm(AbstractForm, adaptive_threshold_ui.Ui_Form):
             self.comboBoxAdaptiveMethod.addItem(i.name)
 
     def get_name(self):
-        return ip.Thresh.name
+        return ip.AdaptThresh.name
 
     def set_image_label_list(self, image_label_list):
         self.commonForm.set_image_label_list(image_label_list)
@@ -265,6 +302,8 @@ class drawContoursForm(AbstractForm, draw_contours_ui.Ui_Form):
         super(drawContoursForm, self).__init__()
         self.commonForm = commonForm()
         self.widget_1.layout().addWidget(self.commonForm)
+        for i in ip.DrawCnt.Hierarchies:
+            self.comboBoxHierarchy.addItem(i.name)
 
     def get_name(self):
         return ip.DrawCnt.name
@@ -272,14 +311,38 @@ class drawContoursForm(AbstractForm, draw_contours_ui.Ui_Form):
     def set_image_label_list(self, image_label_list):
         self.commonForm.set_image_label_list(image_label_list)
 
+    def get_spin_boxes(self):
+        return [('index', self.spinBoxIndex),
+                ('blue', self.spinBoxBlue),
+                ('green', self.spinBoxGreen),
+                ('red', self.spinBoxRed),
+                ('thickness', self.spinBoxThickness),
+                ('minArea', self.spinBoxMinArea),
+                ('maxArea', self.spinBoxMaxArea),
+                ('minPerimeter', self.spinBoxMinPerimeter)]
+
     def get_xml_element(self):
         root = ElementTree.Element('module')
         root.set('name', self.get_name())
         root.append(self.commonForm.get_xml_element())
+        for tag, spin_box in self.get_spin_boxes():
+            elem = ElementTree.SubElement(root, tag)
+            elem.text = str(spin_box.value())
+        elem = ElementTree.SubElement(root, 'hierarchy')
+        elem.text = str(self.comboBoxHierarchy.currentText())
         return root
 
     def set_xml_element(self, root):
         self.commonForm.set_xml_element(root.find('common'))
+        # files saved before these settings existed keep the defaults
+        for tag, spin_box in self.get_spin_boxes():
+            elem = root.find(tag)
+            if elem is not None:
+                spin_box.setValue(int(elem.text))
+        elem = root.find('hierarchy')
+        if elem is not None:
+            hierarchy = ip.DrawCnt.Hierarchies[str(elem.text)]
+            self.comboBoxHierarchy.setCurrentIndex(hierarchy-1)
 
 
 class kNNnumberForm(AbstractForm, knn_number_ui.Ui_Form):
@@ -308,6 +371,36 @@ class kNNnumberForm(AbstractForm, knn_number_ui.Ui_Form):
         self.spinBoxK.setValue(k)
 
 
+class kNNcontoursForm(AbstractForm, knn_contours_ui.Ui_Form):
+    def __init__(self):
+        super(kNNcontoursForm, self).__init__()
+        self.commonForm = commonForm()
+        self.widget_1.layout().addWidget(self.commonForm)
+
+    def get_name(self):
+        return ip.kNNcontours.name
+
+    def set_image_label_list(self, image_label_list):
+        self.commonForm.set_image_label_list(image_label_list)
+
+    def get_xml_element(self):
+        root = ElementTree.Element('module')
+        root.set('name', self.get_name())
+        root.append(self.commonForm.get_xml_element())
+        elem1 = ElementTree.SubElement(root, 'K')
+        elem1.text = str(self.spinBoxK.value())
+        elem2 = ElementTree.SubElement(root, 'minSize')
+        elem2.text = str(self.spinBoxMinSize.value())
+        return root
+
+    def set_xml_element(self, root):
+        self.commonForm.set_xml_element(root.find('common'))
+        k = int(root.find('K').text)
+        min_size = int(root.find('minSize').text)
+        self.spinBoxK.setValue(k)
+        self.spinBoxMinSize.setValue(min_size)
+
+
 class pyocrForm(AbstractForm, pyocr_ui.Ui_Form):
     def __init__(self):
         super(pyocrForm, self).__init__()
@@ -318,15 +411,41 @@ class pyocrForm(AbstractForm, pyocr_ui.Ui_Form):
             self.comboBoxPSMode.addItem(i.name)
         self.comboBoxPSMode.setCurrentIndex(3)
         self.module = None
+        self.populated = False
 
     def set_module(self, module):
+        # a lazily built module is not asked for its tools until the form is
+        # shown, until then the combo boxes only hold the loaded settings
         self.module = module
+        if not isinstance(module, ip.LazyModule) or module.is_built():
+            self.populate()
+        return self.module
+
+    def populate(self):
+        if self.populated:
+            return
+        self.populated = True
+        if isinstance(self.module, ip.LazyModule):
+            self.module.get()
+        tool = self.comboBoxTool.currentText()
+        lang = self.comboBoxLang.currentText()
+        self.comboBoxTool.clear()
         for i in self.module.tool_names:
             self.comboBoxTool.addItem(i)
-        return self.module
+        if tool:
+            self.comboBoxTool.setCurrentText(tool)
+        if lang:
+            self.comboBoxLang.setCurrentText(lang)
+
+    def showEvent(self, event):
+        self.populate()
+        super(pyocrForm, self).showEvent(event)
 
     def set_tool(self):
+        if not self.populated:
+            return
         self.module.setTool(self.comboBoxTool.currentText())
+        self.comboBoxLang.clear()
         for i in self.module.lang_names:
             self.comboBoxLang.addItem(i)
 
@@ -350,7 +469,25 @@ class pyocrForm(AbstractForm, pyocr_ui.Ui_Form):
 
     def set_xml_element(self, root):
         self.commonForm.set_xml_element(root.find('common'))
-        self.comboBoxTool.setCurrentText(str(root.find('tool').text))
-        self.comboBoxLang.setCurrentText(str(root.find('lang').text))
+        tool = str(root.find('tool').text)
+        lang = str(root.find('lang').text)
+        if not self.populated:
+            self.comboBoxTool.addItem(tool)
+            self.comboBoxLang.addItem(lang)
+        self.comboBoxTool.setCurrentText(tool)
+        self.comboBoxLang.setCurrentText(lang)
         psmode = ip.Pyocr.PSModes[str(root.find('psmode').text)]
         self.comboBoxPSMode.setCurrentIndex(psmode-1)
+
+
+# form for each module name of a pipeline file
+form_classes = {'input': inputForm,
+                ip.Canny.name: CannyForm,
+                ip.CvtColor.name: cvtColorForm,
+                ip.Thresh.name: thresholdForm,
+                ip.AdaptThresh.name: adaptiveThresholdForm,
+                ip.FindCnt.name: findContoursForm,
+                ip.DrawCnt.name: drawContoursForm,
+                ip.kNNnumber.name: kNNnumberForm,
+                ip.kNNcontours.name: kNNcontoursForm,
+                ip.Pyocr.name: pyocrForm}
@@ -134,9 +134,17 @@ class Ui_MainWindow(object):
         self.actionPyocr.setObjectName("actionPyocr")
         self.actionAdaptiveThreshold = QtWidgets.QAction(MainWindow)
         self.actionAdaptiveThreshold.setObjectName("actionAdaptiveThreshold")
+        self.actionKNNcontours = QtWidgets.QAction(MainWindow)
+        self.actionKNNcontours.setObjectName("actionKNNcontours")
+        self.actionExportTiming = QtWidgets.QAction(MainWindow)
+        self.actionExportTiming.setObjectName("actionExportTiming")
+        self.actionParameterSweep = QtWidgets.QAction(MainWindow)
+        self.actionParameterSweep.setObjectName("actionParameterSweep")
         self.menu_File.addAction(self.actionOpen)
         self.menu_File.addAction(self.actionSave)
         self.menu_File.addAction(self.actionSave_As)
+        self.menu_File.addAction(self.actionExportTiming)
+        self.menu_File.addAction(self.actionParameterSweep)
         self.menu_File.addAction(self.actionClose)
         self.menuFilter.addAction(self.actionCanny)
         self.menuFilter.addAction(self.actionCvtColor)
@@ -145,6 +153,7 @@ class Ui_MainWindow(object):
         self.menuFilter.addAction(self.actionFindContours)
         self.menuFilter.addAction(self.actionDrawContours)
         self.menuFilter.addAction(self.actionKNNnumber)
+        self.menuFilter.addAction(self.actionKNNcontours)
         self.menuFilter.addAction(self.actionPyocr)
         self.menubar.addAction(self.menu_File.menuAction())
         self.menubar.addAction(self.menuFilter.menuAction())
@@ -175,4 +184,7 @@ class Ui_MainWindow(object):
         self.actionKNNnumber.setText(_translate("MainWindow", "kNNnumber"))
         self.actionPyocr.setText(_translate("MainWindow", "pyocr"))
         self.actionAdaptiveThreshold.setText(_translate("MainWindow", "adaptiveThreshold"))
+        self.actionKNNcontours.setText(_translate("MainWindow", "kNNcontours"))
+        self.actionExportTiming.setText(_translate("MainWindow", "Export Timing"))
+        self.actionParameterSweep.setText(_translate("MainWindow", "Parameter Sweep..."))
 
@@ -1,3 +1,10 @@
+import os
+import sys
+import hashlib
+import threading
+import traceback
+import collections
+from multiprocessing.pool import ThreadPool
 import cv2
 import enum
 import error
@@ -5,27 +12,266 @@ import distutils.util
 import numpy as np
 import pyocr
 from PIL import Image
+try:
+    # optional, keeps tesseract loaded in process (see Pyocr)
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 
-class ImageObj():
-    def __init__(self, image, code, contours=None):
-        self.set(image, code, contours)
+class ImageObj(object):
+    __slots__ = ('image', 'code', 'contours', 'labels', 'hierarchy',
+                 'offset')
 
-    def set(self, image, code, contours=None):
+    def __init__(self, image, code, contours=None, labels=None,
+                 hierarchy=None, offset=None):
+        self.set(image, code, contours, labels, hierarchy, offset)
+
+    def set(self, image, code, contours=None, labels=None, hierarchy=None,
+            offset=None):
         self.image = image
         self.code = code
         self.contours = contours
+        # per contour results (recognized digits) or OCR (word, box) pairs
+        self.labels = labels
+        self.hierarchy = hierarchy  # (1, N, 4) as from findContours
+        # (x, y) of image in the full frame when it is a region of interest,
+        # contours and labels are relative to it as well
+        self.offset = offset
+
+
+class BufferPool():
+    # output buffers owned by one stage, keyed by shape and dtype
+    #
+    # an array is handed out again only when nothing but the pool refers to
+    # it any more (results still cached, displayed or in flight keep it
+    # alive), so stages can pass it to OpenCV as dst= safely.
+    max_buffers = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            buffers = self.buffers.setdefault(key, [])
+            for buf in buffers:
+                # referred only by buffers, buf and getrefcount() itself
+                if sys.getrefcount(buf) <= 3:
+                    return buf
+            buf = np.empty(shape, dtype)
+            self.allocations += 1
+            if len(buffers) < self.max_buffers:
+                buffers.append(buf)
+            return buf
+
+    def copy(self, image):
+        # for stages which really modify their input
+        buf = self.get(image.shape, image.dtype)
+        np.copyto(buf, image)
+        return buf
+
+
+# compiled pipeline stage: parameters are parsed from xml (and cv2 constants
+# are resolved) once, so per-frame processing never touches ElementTree
+class Stage(collections.namedtuple(
+        'Stage', ['module', 'params', 'picture_number', 'contour_number'])):
+    __slots__ = ()
+
+    def get_image(self, obj_img, obj_cnt, buffers=None):
+        if buffers is None:
+            buffers = BufferPool()
+        return self.module.process(self.params, obj_img, obj_cnt, buffers)
+
+
+class LazyModule():
+    # stand-in for a module instance which is expensive to construct (kNN
+    # training, probing OCR tools): it is built on the first frame that
+    # reaches the stage, so opening a pipeline file stays fast
+    def __init__(self, cls):
+        self.cls = cls
+        self.name = cls.name
+        self.parse = cls.parse
+        self.lock = threading.Lock()
+        self.instance = None
+
+    def is_built(self):
+        return self.instance is not None
+
+    def get(self):
+        with self.lock:
+            if self.instance is None:
+                self.instance = self.cls()
+            return self.instance
+
+    def process(self, params, obj_img, obj_cnt, buffers):
+        return self.get().process(params, obj_img, obj_cnt, buffers)
+
+    def close(self):
+        with self.lock:
+            instance = self.instance
+        if instance is not None:
+            close_module(instance)
+
+    def __getattr__(self, name):
+        # e.g. Pyocr.revision, only once the instance exists
+        instance = self.__dict__.get('instance')
+        if instance is None:
+            raise AttributeError(name)
+        return getattr(instance, name)
+
+
+def get_module_class(name):
+    # class for <module name=...> of a pipeline xml, 'input' is cvtColor
+    if name == 'input':
+        return CvtColor
+    for module in module_classes:
+        if module.name == name:
+            return module
+    raise error.ModuleError('unknown module: ' + str(name))
+
+
+def create_module(name, lazy=False):
+    # stateless modules are used as the class itself, the others need an
+    # instance per stage (built on first use with lazy=True)
+    cls = get_module_class(name)
+    if cls not in stateful_classes:
+        return cls
+    if lazy:
+        return LazyModule(cls)
+    return cls()
+
+
+def close_module(module):
+    # release threads etc. of a module instance which is not used any more
+    close = getattr(module, 'close', None)
+    if close is not None:
+        close()
+
+
+def load_stages(root_top):
+    stages = []
+    for root_module in root_top.findall('module'):
+        module = create_module(root_module.get('name'))
+        stages.append(compile_stage(module, root_module))
+    return stages
+
+
+def compile_stage(module, root):
+    root_cmn = root.find('common')
+    picture_number = int(root_cmn.find('picture_number').text)
+    contour_number = int(root_cmn.find('contour_number').text)
+    return Stage(module, module.parse(root), picture_number, contour_number)
+
+
+def to_bgr(obj):
+    # image of obj as BGR (or gray), e.g. for cv2.imwrite
+    if len(obj.image.shape) == 3:
+        cv2_cvt_code = \
+            CvtColor.cv2_cvt_codes[obj.code-1][CvtColor.Codes.BGR-1]
+        if cv2_cvt_code is not None:
+            return cv2.cvtColor(obj.image, cv2_cvt_code)
+    return obj.image
+
+
+def crop(obj, roi):
+    # view (no copy) of the region x, y, width, height of obj, clipped to
+    # the image
+    x, y, w, h = roi
+    height, width = obj.image.shape[:2]
+    x0, y0 = min(max(x, 0), width-1), min(max(y, 0), height-1)
+    x1, y1 = min(x0 + w, width), min(y0 + h, height)
+    offset = (x0, y0)
+    if obj.offset is not None:
+        offset = (obj.offset[0] + x0, obj.offset[1] + y0)
+    return ImageObj(obj.image[y0:y1, x0:x1], obj.code, offset=offset)
+
+
+def to_frame_contours(obj):
+    # contours of obj in full frame coordinates
+    if obj.offset is None or obj.contours is None:
+        return obj.contours
+    offset = np.array(obj.offset, np.int32)
+    return [contour + offset for contour in obj.contours]
+
+
+def to_frame_boxes(obj):
+    # OCR (word, ((x0, y0), (x1, y1))) pairs in full frame coordinates
+    if obj.offset is None or obj.labels is None:
+        return obj.labels
+    dx, dy = obj.offset
+    return [(content, ((p0[0]+dx, p0[1]+dy), (p1[0]+dx, p1[1]+dy)))
+            for (content, (p0, p1)) in obj.labels]
+
+
+def to_frame_detections(obj):
+    # (x, y, w, h, label) in full frame coordinates for every OCR word of
+    # obj (labels is a list of (word, box)) or else every contour (labels,
+    # if any, an array of per contour results such as kNN digits)
+    if isinstance(obj.labels, list):
+        return [(p0[0], p0[1], p1[0]-p0[0], p1[1]-p0[1], content)
+                for (content, (p0, p1)) in to_frame_boxes(obj)]
+    contours = to_frame_contours(obj)
+    if contours is None or len(contours) == 0:
+        return []
+    labels = obj.labels
+    if labels is None:
+        labels = [None] * len(contours)
+    return [(int(x), int(y), int(w), int(h), label)
+            for ((x, y, w, h), label) in zip(contour_rects(contours), labels)]
+
+
+def get_text(root, tag, default):
+    # for elements added after pipeline files were already saved
+    elem = root.find(tag)
+    return default if elem is None else elem.text
+
+
+def contour_rects(contours):
+    # (N, 4) array of x, y, w, h for all contours at once
+    lengths = np.array([len(contour) for contour in contours])
+    points = np.concatenate(contours).reshape(-1, 2)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    mins = np.minimum.reduceat(points, starts)
+    maxs = np.maximum.reduceat(points, starts)
+    return np.hstack([mins, maxs - mins + 1])
+
+
+def contour_measures(contours):
+    # areas and perimeters of all contours at once, the same values as
+    # cv2.contourArea and cv2.arcLength(closed=True) give one by one
+    lengths = np.array([len(contour) for contour in contours])
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    nexts = np.arange(1, len(points)+1)
+    nexts[starts + lengths - 1] = starts  # close each contour
+    x, y = points[:, 0], points[:, 1]
+    areas = np.abs(np.add.reduceat(x * y[nexts] - x[nexts] * y, starts)) / 2
+    steps = np.hypot(x[nexts] - x, y[nexts] - y)
+    perimeters = np.add.reduceat(steps, starts)
+    return (areas, perimeters)
 
 
 class Canny():
     name = 'Canny'
 
-    @staticmethod
-    def get_image(root, obj, _):
+    Params = collections.namedtuple('CannyParams', ['min_val', 'max_val'])
+
+    @classmethod
+    def parse(cls, root):
         min_val = int(root.find('min').text)
         max_val = int(root.find('max').text)
-        image = cv2.Canny(obj.image, min_val, max_val)
-        return ImageObj(image, CvtColor.Codes.GRAY, obj.contours)
+        return cls.Params(min_val, max_val)
+
+    @staticmethod
+    def process(params, obj, _, buffers):
+        dst = buffers.get(obj.image.shape[:2])
+        image = cv2.Canny(obj.image, params.min_val, params.max_val,
+                          edges=dst)
+        return ImageObj(image, CvtColor.Codes.GRAY, obj.contours,
+                        offset=obj.offset)
 
 
 class CvtColor():
@@ -42,15 +288,40 @@ class CvtColor():
          [cv2.COLOR_HLS2BGR, cv2.COLOR_HLS2RGB, None, None, None],
          [cv2.COLOR_GRAY2BGR, cv2.COLOR_GRAY2RGB, None, None, None]]
 
+    Params = collections.namedtuple('CvtColorParams',
+                                    ['code', 'cv2_cvt_codes', 'roi'])
+
     @classmethod
-    def get_image(cls, root, obj, _):
+    def parse(cls, root):
         code = cls.Codes[str(root.find('code').text)]
-        cv2_cvt_code = cls.cv2_cvt_codes[obj.code-1][code-1]
+        # column of cv2_cvt_codes, indexed by the code of input image
+        cv2_cvt_codes = tuple(row[code-1] for row in cls.cv2_cvt_codes)
+        # only the input stage has a region of interest
+        roi = None
+        root_roi = root.find('roi')
+        if root_roi is not None:
+            roi = tuple(int(root_roi.find(tag).text)
+                        for tag in ['x', 'y', 'width', 'height'])
+            if roi[2] <= 0 or roi[3] <= 0:
+                roi = None
+        return cls.Params(code, cv2_cvt_codes, roi)
+
+    @staticmethod
+    def process(params, obj, _, buffers):
+        if params.roi is not None:
+            obj = crop(obj, params.roi)
+        cv2_cvt_code = params.cv2_cvt_codes[obj.code-1]
         if cv2_cvt_code is None:
-            return ImageObj(obj.image, obj.code, obj.contours)
+            return ImageObj(obj.image, obj.code, obj.contours,
+                            offset=obj.offset)
         else:
-            image = cv2.cvtColor(obj.image, cv2_cvt_code)
-            return ImageObj(image, code, obj.contours)
+            if params.code == CvtColor.Codes.GRAY:
+                dst = buffers.get(obj.image.shape[:2])
+            else:
+                dst = buffers.get(obj.image.shape[:2] + (3,))
+            image = cv2.cvtColor(obj.image, cv2_cvt_code, dst=dst)
+            return ImageObj(image, params.code, obj.contours,
+                            offset=obj.offset)
 
 
 class Thresh():
@@ -63,8 +334,11 @@ class Thresh():
         [cv2.THRESH_BINARY, cv2.THRESH_BINARY_INV, cv2.THRESH_TRUNC,
          cv2.THRESH_TOZERO, cv2.THRESH_TOZERO_INV]
 
+    Params = collections.namedtuple(
+        'ThreshParams', ['thresh', 'max_val', 'cv2_thresh_type', 'otsu'])
+
     @classmethod
-    def get_image(cls, root, obj, _):
+    def parse(cls, root):
         thresh = int(root.find('thresh').text)
         max_val = int(root.find('maxVal').text)
         thresh_type_str = str(root.find('threshType').text)
@@ -72,12 +346,18 @@ class Thresh():
         cv2_thresh_type = cls.cv2_thresh_types[thresh_type-1]
         otsu_bool = distutils.util.strtobool(str(root.find('otsu').text))
         if otsu_bool:
-            if len(obj.image.shape) is not 2:
-                raise error.ModuleError('input image must be one color only!')
             thresh = 0
             cv2_thresh_type = cv2_thresh_type + cv2.THRESH_OTSU
-        _, image = cv2.threshold(obj.image, thresh, max_val, cv2_thresh_type)
-        return ImageObj(image, obj.code, obj.contours)
+        return cls.Params(thresh, max_val, cv2_thresh_type, bool(otsu_bool))
+
+    @staticmethod
+    def process(params, obj, _, buffers):
+        if params.otsu and len(obj.image.shape) is not 2:
+            raise error.ModuleError('input image must be one color only!')
+        dst = buffers.get(obj.image.shape, obj.image.dtype)
+        _, image = cv2.threshold(obj.image, params.thresh, params.max_val,
+                                 params.cv2_thresh_type, dst=dst)
+        return ImageObj(image, obj.code, obj.contours, offset=obj.offset)
 
 
 class AdaptThresh():
@@ -96,19 +376,29 @@ class AdaptThresh():
     cv2_adapt_methods = \
         [cv2.ADAPTIVE_THRESH_MEAN_C, cv2.ADAPTIVE_THRESH_GAUSSIAN_C]
 
+    Params = collections.namedtuple(
+        'AdaptThreshParams', ['mv', 'cv2_am', 'cv2_tt', 'bs', 'p1'])
+
     @classmethod
-    def get_image(cls, root, obj, _):
-        if len(obj.image.shape) is not 2:
-            raise error.ModuleError('input image must be one color only!')
+    def parse(cls, root):
         mv = int(root.find('maxValue').text)
         bs = int(root.find('blockSize').text)
         p1 = int(root.find('param1').text)
-        am = AdaptThresh.AdaptMethods[str(root.find('adaptiveMethod').text)]
-        tt = AdaptThresh.ThreshTypes[str(root.find('thresholdType').text)]
+        am = cls.AdaptMethods[str(root.find('adaptiveMethod').text)]
+        tt = cls.ThreshTypes[str(root.find('thresholdType').text)]
         cv2_am = cls.cv2_adapt_methods[am-1]
         cv2_tt = cls.cv2_thresh_types[tt-1]
-        image = cv2.adaptiveThreshold(obj.image, mv, cv2_am, cv2_tt, bs, p1)
-        return ImageObj(image, obj.code, obj.contours)
+        return cls.Params(mv, cv2_am, cv2_tt, bs, p1)
+
+    @staticmethod
+    def process(params, obj, _, buffers):
+        if len(obj.image.shape) is not 2:
+            raise error.ModuleError('input image must be one color only!')
+        dst = buffers.get(obj.image.shape)
+        image = cv2.adaptiveThreshold(obj.image, params.mv, params.cv2_am,
+                                      params.cv2_tt, params.bs, params.p1,
+                                      dst=dst)
+        return ImageObj(image, obj.code, obj.contours, offset=obj.offset)
 
 
 class FindCnt():
@@ -125,59 +415,233 @@ class FindCnt():
         [cv2.CHAIN_APPROX_NONE, cv2.CHAIN_APPROX_SIMPLE,
          cv2.CHAIN_APPROX_TC89_L1, cv2.CHAIN_APPROX_TC89_KCOS]
 
+    Params = collections.namedtuple('FindCntParams',
+                                    ['cv2_mode', 'cv2_method'])
+
     @classmethod
-    def get_image(cls, root, obj, _):
+    def parse(cls, root):
         mode = cls.Modes[str(root.find('mode').text)]
         method = cls.Methods[str(root.find('method').text)]
         cv2_mode = cls.cv2_modes[mode-1]
         cv2_method = cls.cv2_methods[method-1]
+        return cls.Params(cv2_mode, cv2_method)
+
+    @staticmethod
+    def process(params, obj, _, buffers):
         if len(obj.image.shape) is not 2:
             raise error.ModuleError('input image should be one color only!')
-        image = obj.image.copy()
-        contours, hierarchy = cv2.findContours(image, cv2_mode, cv2_method)
-        return ImageObj(image, obj.code, contours)
+        # findContours modifies its input, so it gets a scratch copy and the
+        # untouched input is passed on
+        scratch = buffers.copy(obj.image)
+        contours, hierarchy = cv2.findContours(scratch, params.cv2_mode,
+                                               params.cv2_method)
+        return ImageObj(obj.image, obj.code, contours, hierarchy=hierarchy,
+                        offset=obj.offset)
 
 
 class DrawCnt():
     name = 'drawContours'
 
-    @staticmethod
-    def get_image(root, obj_img, obj_cnt):
-        cnt_index = -1
-        color = (0, 255, 0)
-        thickness = 3
-        image = obj_img.image.copy()
-        cv2.drawContours(image, obj_cnt.contours,
-                         cnt_index, color, thickness)
-        return ImageObj(image, obj_img.code, obj_cnt.contours)
+    hierarchy_names = ['ALL', 'OUTER', 'INNER']
+    Hierarchies = enum.IntEnum('ContourHierarchy', hierarchy_names)
+
+    Params = collections.namedtuple(
+        'DrawCntParams', ['cnt_index', 'color', 'thickness', 'min_area',
+                          'max_area', 'min_perimeter', 'hierarchy'])
+
+    # the filters select the contours to draw, then all of them are drawn
+    # with one drawContours call into a pooled copy of the input. the
+    # pipeline cache already skips the stage while its inputs are unchanged.
+    @classmethod
+    def parse(cls, root):
+        cnt_index = int(get_text(root, 'index', -1))
+        color = (int(get_text(root, 'blue', 0)),
+                 int(get_text(root, 'green', 255)),
+                 int(get_text(root, 'red', 0)))
+        thickness = int(get_text(root, 'thickness', 3))
+        min_area = int(get_text(root, 'minArea', 0))
+        max_area = int(get_text(root, 'maxArea', 0))
+        min_perimeter = int(get_text(root, 'minPerimeter', 0))
+        hierarchy = cls.Hierarchies[str(get_text(root, 'hierarchy', 'ALL'))]
+        return cls.Params(cnt_index, color, thickness, min_area, max_area,
+                          min_perimeter, hierarchy)
+
+    @classmethod
+    def select(cls, params, contours, hierarchy):
+        # indices of the contours to draw, all filters evaluated at once
+        keep = np.ones(len(contours), np.bool_)
+        if params.cnt_index >= 0:
+            keep[:] = False
+            keep[params.cnt_index:params.cnt_index+1] = True
+        if len(contours) == 0:
+            return np.flatnonzero(keep)
+        if params.min_area > 0 or params.max_area > 0 or \
+                params.min_perimeter > 0:
+            areas, perimeters = contour_measures(contours)
+            keep &= areas >= params.min_area
+            if params.max_area > 0:
+                keep &= areas <= params.max_area
+            keep &= perimeters >= params.min_perimeter
+        if params.hierarchy != cls.Hierarchies.ALL and hierarchy is not None:
+            parents = hierarchy.reshape(-1, 4)[:, 3]
+            if params.hierarchy == cls.Hierarchies.OUTER:
+                keep &= parents == -1
+            else:
+                keep &= parents != -1
+        return np.flatnonzero(keep)
+
+    @classmethod
+    def process(cls, params, obj_img, obj_cnt, buffers):
+        if obj_cnt.contours is None:
+            raise error.ModuleError('input contours is None!')
+        image = buffers.copy(obj_img.image)
+        contours = obj_cnt.contours
+        selected = [contours[i]
+                    for i in cls.select(params, contours, obj_cnt.hierarchy)]
+        if len(selected) != 0:
+            cv2.drawContours(image, selected, -1, params.color,
+                             params.thickness)
+        return ImageObj(image, obj_img.code, obj_cnt.contours,
+                        obj_cnt.labels, obj_cnt.hierarchy, obj_img.offset)
 
 
 class kNNnumber():
     name = 'kNNnumber'
 
+    Params = collections.namedtuple('kNNnumberParams', ['k'])
+
+    # digits.png is split into 20x20 cells, the flattened float32 cells and
+    # their labels are cached next to it as .npy and memory-mapped
+    train_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'digits.png')
+    cache_files = [os.path.splitext(train_file)[0] + '_train.npy',
+                   os.path.splitext(train_file)[0] + '_labels.npy']
+
+    # trained once per process and shared by every kNNnumber stage
+    shared_knn = None
+    shared_lock = threading.Lock()
+
     def __init__(self):
-        train_color = cv2.imread('./digits.png')
+        self.knn = self.get_knn()
+
+    @classmethod
+    def get_knn(cls):
+        # on kNNnumber itself, so subclasses share the same model
+        with kNNnumber.shared_lock:
+            if kNNnumber.shared_knn is None:
+                train, train_labels = cls.load_train()
+                knn = cv2.KNearest()
+                knn.train(train, train_labels)
+                kNNnumber.shared_knn = knn
+            return kNNnumber.shared_knn
+
+    @classmethod
+    def load_train(cls):
+        if not os.path.exists(cls.train_file):
+            raise error.ModuleError('training file not found!')
+        mtime = os.path.getmtime(cls.train_file)
+        if all(os.path.exists(f) and mtime <= os.path.getmtime(f)
+               for f in cls.cache_files):
+            return [np.load(f, mmap_mode='r') for f in cls.cache_files]
+
+        train_color = cv2.imread(cls.train_file)
         train_gray = cv2.cvtColor(train_color, cv2.COLOR_BGR2GRAY)
         train_cell = [np.hsplit(row, 100) for row in np.vsplit(train_gray, 50)]
         x = np.array(train_cell)
         train = x[:, :].reshape(-1, 400).astype(np.float32)
         k = np.arange(10)
-        train_labels = np.repeat(k, 500)[:, np.newaxis]
-        self.knn = cv2.KNearest()
-        self.knn.train(train, train_labels)
+        train_labels = np.repeat(k, 500)[:, np.newaxis].astype(np.float32)
+        try:
+            np.save(cls.cache_files[0], train)
+            np.save(cls.cache_files[1], train_labels)
+        except (IOError, OSError):
+            pass  # read-only directory, train from the png every time
+        return [train, train_labels]
+
+    def classify(self, samples, k):
+        # samples: (N, 400) float32, one flattened 20x20 cell per row,
+        # classified by a single find_nearest call
+        if len(samples) == 0:
+            return np.zeros(0, np.int32)
+        ret, results, neighbours, dist = self.knn.find_nearest(samples, k)
+        return results.ravel().astype(np.int32)
 
-    def get_image(self, root, obj, _):
+    @classmethod
+    def parse(cls, root):
+        k = int(root.find('K').text)
+        return cls.Params(k)
+
+    def process(self, params, obj, _, buffers):
         if len(obj.image.shape) is not 2:
             raise error.ModuleError('input image must be one color only!')
-        k = int(root.find('K').text)
         test_gray = cv2.resize(obj.image, (20, 20))
         test = test_gray.reshape(-1, 400).astype(np.float32)
-        ret, result, neighbours, dist = self.knn.find_nearest(test, k)
-        image = obj.image.copy()
+        result = self.classify(test, params.k)
+        image = buffers.copy(obj.image)
         cv2.rectangle(image, (0, 0), (100, 100), (0, 0, 0), -1)
-        cv2.putText(image, str(int(result[0][0])), (0, 100),
+        cv2.putText(image, str(result[0]), (0, 100),
                     cv2.FONT_HERSHEY_PLAIN, 8, (255, 255, 255))
-        return ImageObj(image, obj.code, obj.contours)
+        return ImageObj(image, obj.code, obj.contours, offset=obj.offset)
+
+
+class kNNcontours(kNNnumber):
+    name = 'kNNcontours'
+
+    Params = collections.namedtuple('kNNcontoursParams', ['k', 'min_size'])
+
+    cell_size = 20
+    cell_scale = 2  # samples per cell pixel (per axis), averaged
+    margin = 1.25   # training digits do not fill their cells
+
+    @classmethod
+    def parse(cls, root):
+        k = int(root.find('K').text)
+        min_size = int(root.find('minSize').text)
+        return cls.Params(k, min_size)
+
+    @classmethod
+    def extract_cells(cls, image, rects):
+        # square region around each rect sampled on a regular grid with one
+        # fancy indexing, then averaged down to (N, cell_size**2) float32
+        n = cls.cell_size * cls.cell_scale
+        sides = rects[:, 2:4].max(axis=1) * cls.margin
+        x0 = rects[:, 0] + rects[:, 2] / 2.0 - sides / 2.0
+        y0 = rects[:, 1] + rects[:, 3] / 2.0 - sides / 2.0
+        steps = (np.arange(n) + 0.5) / n
+        xs = (x0[:, np.newaxis] + steps * sides[:, np.newaxis]).astype(np.intp)
+        ys = (y0[:, np.newaxis] + steps * sides[:, np.newaxis]).astype(np.intp)
+        xs = np.clip(xs, 0, image.shape[1]-1)
+        ys = np.clip(ys, 0, image.shape[0]-1)
+        cells = image[ys[:, :, np.newaxis], xs[:, np.newaxis, :]]
+        cells = cells.reshape(-1, cls.cell_size, cls.cell_scale,
+                              cls.cell_size, cls.cell_scale)
+        cells = cells.mean(axis=4, dtype=np.float32).mean(axis=2)
+        return cells.reshape(-1, cls.cell_size**2)
+
+    def process(self, params, obj_img, obj_cnt, buffers):
+        if len(obj_img.image.shape) != 2:
+            raise error.ModuleError('input image must be one color only!')
+        if obj_cnt.contours is None:
+            raise error.ModuleError('input contours is None!')
+        contours = obj_cnt.contours
+        labels = -np.ones(len(contours), np.int32)
+        image = buffers.copy(obj_img.image)
+        if len(contours) == 0:
+            return ImageObj(image, obj_img.code, contours, labels,
+                            offset=obj_img.offset)
+
+        rects = contour_rects(contours)
+        valid = np.flatnonzero((rects[:, 2] >= params.min_size) &
+                               (rects[:, 3] >= params.min_size))
+        cells = self.extract_cells(obj_img.image, rects[valid])
+        labels[valid] = self.classify(cells, params.k)
+        for index in valid:
+            x, y, w, h = [int(v) for v in rects[index]]
+            cv2.rectangle(image, (x, y), (x+w, y+h), (255, 255, 255), 1)
+            cv2.putText(image, str(labels[index]), (x, y),
+                        cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255))
+        return ImageObj(image, obj_img.code, contours, labels,
+                        offset=obj_img.offset)
 
 
 class Pyocr():
@@ -197,31 +661,165 @@ class Pyocr():
          'Treat_the_image_as_a_single_character.']
     PSModes = enum.IntEnum('PageSegmentationMode', psmodes_names)
 
+    Params = collections.namedtuple('PyocrParams', ['tool', 'lang', 'psmode'])
+
+    # OCR runs asynchronously on worker threads and each frame shows the
+    # last completed result. pyocr starts a tesseract process and writes a
+    # temporary image for every call, so with tesserocr installed tesseract
+    # is used through its API instead: each worker keeps one initialized
+    # TessBaseAPI for as long as the stage exists. without tesserocr (it
+    # needs the tesseract headers to build) the workers fall back to pyocr.
+    # results are cached by a digest of the exact input, so an unchanged
+    # region is not recognized again. with workers = 0 OCR is synchronous.
+    workers = 2
+    max_cache = 32
+
     def __init__(self):
         self.tools = pyocr.get_available_tools()
         if len(self.tools) == 0:
             raise error.ModuleError('No OCR tool found')
         self.tool_names = map(lambda n:n.get_name(), self.tools)
         self.setTool(self.tool_names[0])
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.pending = set()
+        self.last = []
+        # incremented whenever a recognition completes, see Job.get_key()
+        self.revision = 0
+        self.pool = ThreadPool(self.workers) if self.workers > 0 else None
+        self.closed = False
+        # TessBaseAPI of the current thread, and all of them for close()
+        self.local = threading.local()
+        self.apis = []
+
+    def close(self):
+        # called by the pipeline when the stage is dropped
+        with self.lock:
+            self.closed = True
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        with self.lock:
+            apis, self.apis = self.apis, []
+        for api in apis:
+            api.End()
 
     def setTool(self, tool_name):
+        self.tool = self.get_tool(tool_name)
+        self.lang_names = self.tool.get_available_languages()
+
+    def get_tool(self, tool_name):
         for tool in self.tools:
             if tool.get_name() == tool_name:
-                self.tool = tool
-                break
-        self.lang_names = self.tool.get_available_languages()
+                return tool
+        return self.tool
 
-    def get_image(self, root, obj, _):
+    @classmethod
+    def parse(cls, root):
+        tool = str(root.find('tool').text)
         lang = str(root.find('lang').text)
-        psmode = self.PSModes[str(root.find('psmode').text)]-1
-        image = obj.image.copy()
-        builder = pyocr.builders.WordBoxBuilder(tesseract_layout=psmode)
-        res = self.tool.image_to_string(Image.fromarray(image),
-                                        lang=lang,
-                                        builder=builder)
-        for d in res:
-            print d.content
-            cv2.rectangle(image, d.position[0], d.position[1], (0, 0, 255), 2)
-            cv2.putText(image, (d.content).encode('utf-8'), d.position[0],
+        psmode = cls.PSModes[str(root.find('psmode').text)]-1
+        return cls.Params(tool, lang, psmode)
+
+    @staticmethod
+    def get_digest(image):
+        # of the exact pixels, a single changed digit is a new key
+        return hashlib.sha1(np.ascontiguousarray(image).data).digest()
+
+    def get_api(self, lang):
+        api = getattr(self.local, 'api', None)
+        if api is not None and self.local.lang == lang:
+            return api
+        if api is not None:
+            with self.lock:
+                self.apis.remove(api)
+            api.End()
+        api = tesserocr.PyTessBaseAPI(lang=lang)
+        self.local.api = api
+        self.local.lang = lang
+        with self.lock:
+            self.apis.append(api)
+        return api
+
+    def recognize_api(self, params, image):
+        api = self.get_api(params.lang)
+        api.SetPageSegMode(params.psmode)
+        api.SetImage(Image.fromarray(image))
+        api.Recognize()
+        boxes = []
+        iterator = api.GetIterator()
+        if iterator is None:
+            return boxes
+        level = tesserocr.RIL.WORD
+        for word in tesserocr.iterate_level(iterator, level):
+            content = word.GetUTF8Text(level)
+            box = word.BoundingBox(level)
+            if content is None or box is None:
+                continue
+            boxes.append((content, ((box[0], box[1]), (box[2], box[3]))))
+        return boxes
+
+    def recognize(self, params, image):
+        if tesserocr is not None and 'Tesseract' in params.tool:
+            return self.recognize_api(params, image)
+        builder = pyocr.builders.WordBoxBuilder(tesseract_layout=params.psmode)
+        tool = self.get_tool(params.tool)
+        res = tool.image_to_string(Image.fromarray(image),
+                                   lang=params.lang,
+                                   builder=builder)
+        return [(d.content, d.position) for d in res]
+
+    def recognize_async(self, key, params, image):
+        try:
+            boxes = self.recognize(params, image)
+        except Exception:
+            traceback.print_exc()
+            boxes = None
+        with self.lock:
+            self.pending.discard(key)
+            if boxes is not None:
+                self.store(key, boxes)
+
+    def store(self, key, boxes):
+        self.cache[key] = boxes
+        while len(self.cache) > self.max_cache:
+            self.cache.popitem(last=False)
+        self.last = boxes
+        self.revision += 1
+
+    def get_boxes(self, params, image):
+        key = (self.get_digest(image), image.shape, image.dtype, params)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            if self.closed:
+                return self.last
+            if self.pool is not None:
+                if key not in self.pending and \
+                        len(self.pending) < self.workers:
+                    self.pending.add(key)
+                    self.pool.apply_async(self.recognize_async,
+                                          (key, params, image.copy()))
+                return self.last
+        # synchronous, recognized without holding the lock like
+        # recognize_async (get_api takes it too)
+        boxes = self.recognize(params, image)
+        with self.lock:
+            self.store(key, boxes)
+        return boxes
+
+    def process(self, params, obj, _, buffers):
+        boxes = self.get_boxes(params, obj.image)
+        image = buffers.copy(obj.image)
+        for (content, position) in boxes:
+            cv2.rectangle(image, position[0], position[1], (0, 0, 255), 2)
+            cv2.putText(image, content.encode('utf-8'), position[0],
                         cv2.FONT_HERSHEY_PLAIN, 8, (0, 0, 0))
-        return ImageObj(image, obj.code, obj.contours)
+        return ImageObj(image, obj.code, obj.contours, boxes,
+                        offset=obj.offset)
+
+
+module_classes = [Canny, CvtColor, Thresh, AdaptThresh, FindCnt, DrawCnt,
+                  kNNnumber, kNNcontours, Pyocr]
+stateful_classes = [kNNnumber, kNNcontours, Pyocr]
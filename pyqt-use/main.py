@@ -1,14 +1,24 @@
 import sys
 import os
-from datetime import datetime
+import time
+import threading
+import traceback
 from PyQt5 import QtGui, QtWidgets, QtCore
 from xml.etree import ElementTree
-from xml.dom import minidom
 import cv2
+import numpy as np
 from gui import main_window
 import forms
-import error
 import imageprocess as ip
+import pipeline
+import capture
+import engine
+import display
+import profiler
+import project
+import sources
+import sweep
+import error
 
 # version check
 from platform import python_version
@@ -21,37 +31,72 @@ from sip import SIP_VERSION_STR
 # assert(SIP_VERSION_STR == '4.18')
 # assert(cv2.__version__ == '2.4.11')
 
+file_filter = 'Pipeline (*.xml *.json);;All files (*)'
+
 
 class MainForm(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
-    def __init__(self):
+    # the first source is processed here, any further sources are
+    # SourceProcess instances running the same pipeline; with more than one
+    # source the display shows all of them as tiles
+    tile_size = (320, 240)
+    sigSweepDone = QtCore.pyqtSignal(object)
+
+    def __init__(self, spec='0', source_list=[]):
         super(self.__class__, self).__init__()
         self.setupUi(self)
         self.actionOpen.triggered.connect(self.open)
         self.actionSave.triggered.connect(self.save)
         self.actionSave_As.triggered.connect(self.save_as)
+        self.actionExportTiming.triggered.connect(self.export_timing)
+        self.actionParameterSweep.triggered.connect(self.sweep_parameters)
+        self.sigSweepDone.connect(self.show_sweep)
         self.actionClose.triggered.connect(QtWidgets.qApp.quit)
-        self.actionCanny.triggered.connect(self.add_canny)
-        self.actionCvtColor.triggered.connect(self.add_cvt_color)
-        self.actionThreshold.triggered.connect(self.add_threshold)
-        self.actionAdaptiveThreshold \
-            .triggered.connect(self.add_adaptive_threshold)
-        self.actionFindContours.triggered.connect(self.add_find_contours)
-        self.actionDrawContours.triggered.connect(self.add_draw_contours)
-        self.actionKNNnumber.triggered.connect(self.add_knn_number)
-        self.actionPyocr.triggered.connect(self.add_pyocr)
+        for (action, module) in [(self.actionCanny, ip.Canny),
+                                 (self.actionCvtColor, ip.CvtColor),
+                                 (self.actionThreshold, ip.Thresh),
+                                 (self.actionAdaptiveThreshold,
+                                  ip.AdaptThresh),
+                                 (self.actionFindContours, ip.FindCnt),
+                                 (self.actionDrawContours, ip.DrawCnt),
+                                 (self.actionKNNnumber, ip.kNNnumber),
+                                 (self.actionKNNcontours, ip.kNNcontours),
+                                 (self.actionPyocr, ip.Pyocr)]:
+            action.triggered.connect(
+                lambda checked, name=module.name: self.add_module(name))
 
         self.toolButtonToggle.setCheckable(True)
         self.toolButtonToggle.toggled.connect(self.toggle_video)
         self.toolButtonCapture.clicked.connect(self.update_image)
         self.toolButtonRefresh.clicked.connect(self.refresh_image)
+        self.comboBoxSelectImages.currentIndexChanged \
+            .connect(lambda: self.select_image())
         self.pushButtonDelete.clicked.connect(lambda: self.del_items())
         self.show()
 
-        self.capture = cv2.VideoCapture(0)
+        self.capture = capture.open_source(spec)
+        # frames are held by MainForm, by jobs in flight and by the
+        # committed results, so the ring needs a few spare slots
+        self.capturer = capture.CaptureWorker(self.capture, size=6)
+        self.capturer.start()
+        self.frame_id = None
+        self.shown_frame_id = None
         self.scene = QtWidgets.QGraphicsScene()
         self.pixitem = QtWidgets.QGraphicsPixmapItem()
         self.scene.addItem(self.pixitem)
         self.graphicsView.setScene(self.scene)
+        self.display = display.ImageDisplay(self.pixitem, self.graphicsView)
+        # a rectangle dragged on the view becomes the region of interest
+        self.graphicsView.setDragMode(QtWidgets.QGraphicsView.RubberBandDrag)
+        self.graphicsView.rubberBandChanged.connect(self.select_roi)
+        self.roi_points = None
+        self.roi_canvas = None
+        self.source_list = source_list
+        self.tile_list = [None] * len(source_list)
+        # what the other sources have to be sent at the next refresh
+        self.sources_structure = True   # the whole pipeline
+        self.sources_stages = set()     # indices of edited stages
+        self.sources_output = None      # output index sent last
+        self.canvas = display.TileCanvas(self.tile_size)
 
         self.filename = '/home/yasunori/workspace/myapp/opencv-gui/test.xml'
         self.dirname = '/home/yasunori/workspace/myapp/opencv-gui'
@@ -59,75 +104,65 @@ class MainForm(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
         # self.dirname = '/home'
         self.form_list = []
         self.module_list = []
-        self.image_list = []
+        self.pipeline = pipeline.Pipeline()
+        self.pipeline.set_frame(self.capture_image(), self.frame_id)
+        self.engine = engine.ProcessingEngine(self.pipeline)
+        self.engine.sigFinished.connect(self.finish_image)
+        self.profiler = profiler.StageProfiler()
+        self.profile_time = 0.0
         self.toolBox.removeItem(0)
-        self.add_input()
+        self.add_module('input')
 
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.update_image)
-        self.timer.start(100)
+        self.timer.start(15)
 
     def open(self):
         filename_list = QtWidgets.QFileDialog. \
-            getOpenFileName(self, 'Open File', self.dirname)
+            getOpenFileName(self, 'Open File', self.dirname, file_filter)
         self.filename = filename_list[0]
         self.dirname = os.path.dirname(self.filename)
-        root_top = ElementTree.parse(self.filename)
+        root_top = project.load(self.filename)
         del self.form_list[:]
         del self.module_list[:]
-        del self.image_list[:]
+        self.pipeline.clear()
         while self.toolBox.count() != 0:
             self.toolBox.removeItem(0)
 
-        root_module_list = []
-        for root_module in root_top.findall('module'):
-            root_module_list.append(root_module)
-            module_str = root_module.get('name')
-            if module_str == 'input':
-                form, module = self.add_input()
-
-            elif module_str == ip.Canny.name:
-                form, module = self.add_canny()
-
-            elif module_str == ip.CvtColor.name:
-                form, module = self.add_cvt_color()
-
-            elif module_str == ip.Thresh.name:
-                form, module = self.add_threshold()
-
-            elif module_str == ip.FindCnt.name:
-                form, module = self.add_find_contours()
-
-            elif module_str == ip.DrawCnt.name:
-                form, module = self.add_draw_contours()
-
-            elif module_str == ip.kNNnumber.name:
-                form, module = self.add_knn_number()
-
-            else:
-                print module_str
+        # modules are built when the first frame reaches them
+        root_module_list = root_top.findall('module')
+        for root_module in root_module_list:
+            name = root_module.get('name')
+            if name not in forms.form_classes:
+                print name
                 assert(False)
                 return None
+            self.add_module(name, lazy=True, update=False)
+        self.update_form()
 
         for form, root_module in zip(self.form_list, root_module_list):
+            form.blockSignals(True)
             form.set_xml_element(root_module)
+            form.blockSignals(False)
+            self.compile_stage(form)
 
     def save(self):
         if self.filename is None:
             self.save_as()
             return
+        project.save(self.filename, self.get_xml_element())
+
+    def get_xml_element(self):
         root_top = ElementTree.Element('top')
         for (index, form) in enumerate(self.form_list):
             root_form = form.get_xml_element()
             assert(root_form is not None)
             root_top.append(root_form)
-        root_top = minidom.parseString(ElementTree.tostring(root_top, 'utf-8'))
-        with open(self.filename, "w") as file:
-            file.write(root_top.toprettyxml(indent="  "))
+        return root_top
 
     def save_as(self):
         filename_list = QtWidgets.QFileDialog. \
-            getSaveFileName(self, 'Save file', self.dirname)
+            getSaveFileName(self, 'Save file', self.dirname, file_filter)
         self.filename = filename_list[0]
         self.dirname = os.path.dirname(self.filename)
         self.save()
@@ -142,77 +177,26 @@ class MainForm(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
             self.toolButtonRefresh.setEnabled(False)
             self.timer.start()
 
-    def add_input(self):
-        form = forms.inputForm()
-        module = ip.CvtColor
-        name = 'input'
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_canny(self):
-        form = forms.CannyForm()
-        module = ip.Canny
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_cvt_color(self):
-        form = forms.cvtColorForm()
-        module = ip.CvtColor
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_threshold(self):
-        form = forms.thresholdForm()
-        module = ip.Thresh
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_adaptive_threshold(self):
-        form = forms.adaptiveThresholdForm()
-        module = ip.AdaptThresh
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_find_contours(self):
-        form = forms.findContoursForm()
-        module = ip.FindCnt
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_draw_contours(self):
-        form = forms.drawContoursForm()
-        module = ip.DrawCnt
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def add_knn_number(self):
-        form = forms.kNNnumberForm()
-        module = ip.kNNnumber()
-        name = module.name
-        self.insert_items(form, module, name)
+    def add_module(self, name, lazy=False, update=True):
+        form = forms.form_classes[name]()
+        module = form.set_module(ip.create_module(name, lazy))
+        self.insert_items(form, module, form.get_name(), update)
         return (form, module)
 
-    def add_pyocr(self):
-        form = forms.pyocrForm()
-        module = form.set_module(ip.Pyocr())
-        name = module.name
-        self.insert_items(form, module, name)
-        return (form, module)
-
-    def insert_items(self, form, module, string):
+    def insert_items(self, form, module, string, update=True):
         index = self.toolBox.currentIndex()+1
-        self.image_list.insert(index, self.capture_image())
+        self.pipeline.insert(index, None)
         self.module_list.insert(index, module)
         self.form_list.insert(index, form)
         self.toolBox.insertItem(index, form, string)
         self.toolBox.setCurrentIndex(index)
-        self.update_form()
+        self.sources_structure = True
+        form.connect_changed()
+        form.sigChanged.connect(lambda: self.compile_stage(form))
+        # when opening a file, this is done once all stages are inserted
+        if update:
+            self.compile_stage(form)
+            self.update_form()
 
     def del_items(self):
         index = self.toolBox.currentIndex()
@@ -220,10 +204,11 @@ class MainForm(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
             pass
         else:
             self.toolBox.removeItem(index)
-            del self.image_list[index]
+            self.pipeline.remove(index)
             del self.module_list[index]
             del self.form_list[index]
             self.update_form()
+            self.sources_structure = True
 
     def update_form(self):
         image_label_list = []
@@ -234,61 +219,271 @@ class MainForm(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
         self.comboBoxSelectImages.addItems(image_label_list)
         self.comboBoxSelectImages.setCurrentIndex(len(image_label_list)-1)
 
+    def compile_stage(self, form):
+        if form not in self.form_list:
+            return
+        index = self.form_list.index(form)
+        root = form.get_xml_element()
+        assert(root is not None)
+        self.pipeline.set_stage(
+            index, ip.compile_stage(self.module_list[index], root))
+        self.sources_stages.add(index)
+
+    def update_sources(self):
+        # the other sources get the changes once per refresh at most: the
+        # whole pipeline only when stages were inserted or removed, else
+        # just the edited stages
+        if self.sources_structure:
+            root_top = self.get_xml_element()
+            for source in self.source_list:
+                source.set_pipeline(root_top)
+        else:
+            for index in sorted(self.sources_stages):
+                root = self.form_list[index].get_xml_element()
+                for source in self.source_list:
+                    source.set_stage(index, root)
+        self.sources_structure = False
+        self.sources_stages.clear()
+        output = self.comboBoxSelectImages.currentIndex()
+        if output != self.sources_output:
+            for source in self.source_list:
+                source.set_output(output)
+            self.sources_output = output
+
     def capture_image(self):
-        success, self.raw_image = self.capture.read()
-        assert(success)
+        frame_id, image = self.capturer.latest(timeout=1.0)
+        assert(frame_id is not None)
+        # the pipeline keeps only the newest frame, so hand back the old one
+        if self.frame_id is not None:
+            self.capturer.release(self.frame_id)
+        self.frame_id = frame_id
+        self.raw_image = image
         return ip.ImageObj(self.raw_image, ip.CvtColor.Codes.BGR)
 
     def update_image(self):
-        self.image_list[0] = self.capture_image()
+        self.update_tiles()
+        frame_id = self.frame_id
+        obj = self.capture_image()
+        if self.frame_id == frame_id:
+            return
+        self.pipeline.set_frame(obj, self.frame_id)
         self.refresh_image()
 
+    def show_status(self):
+        captured, dropped, duplicated = self.capturer.get_counters()
+        latency, throughput = self.engine.get_stats()
+        message = 'captured: %d, dropped: %d, duplicated: %d, ' \
+            'latency: %.1f ms, throughput: %.1f fps, skipped: %d' \
+            % (captured, dropped, duplicated,
+               latency*1000, throughput, self.engine.dropped)
+        for (index, tile) in enumerate(self.tile_list):
+            if tile is not None:
+                frame_id, image, times, counters = tile
+                message += ', source %d: %d/%d dropped' \
+                    % (index+1, counters[1], counters[0])
+        self.statusbar.showMessage(message)
+
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.engine.close()
+        self.capturer.quit()
+        self.capturer.join()
+        self.capture.release()
+        for source in self.source_list:
+            source.quit()
+        for source in self.source_list:
+            source.join(1.0)
+        super(MainForm, self).closeEvent(event)
+
+    def update_tiles(self):
+        updated = False
+        for (index, source) in enumerate(self.source_list):
+            tile = source.get_tile()
+            if tile is not None:
+                self.tile_list[index] = tile
+                updated = True
+        # with jobs in flight finish_image() shows them soon
+        if updated and self.engine.jobs == 0:
+            self.show_image()
+
     def refresh_image(self):
-        for (index, form) in enumerate(self.form_list):
-            module = self.module_list[index]
-            root = form.get_xml_element()
-            assert(root is not None)
-            try:
-                self.image_list[index] = \
-                    self.excute_image_processing(root, module)
-            except error.ModuleError as e:
-                print e, datetime.now()
-                self.image_list[index] = None
-
-        if self.image_list[-1] is None:
-            image = self.raw_image
+        self.update_sources()
+        # each job in flight holds its frame until finish_image()
+        self.capturer.retain(self.frame_id)
+        if self.engine.submit() is None:
+            self.capturer.release(self.frame_id)
+
+    def finish_image(self, job):
+        if job.committed:
+            # committed results may refer to the frame, keep it until the
+            # next commit instead of the job
+            if self.shown_frame_id is not None:
+                self.capturer.release(self.shown_frame_id)
+            self.shown_frame_id = job.frame_id
+            self.show_image()
+            self.profiler.record(job, [f.get_name() for f in self.form_list])
         else:
-            index = self.comboBoxSelectImages.currentIndex()
-            image = self.image_list[index].image
-
-        assert(2 <= len(image.shape) or len(image.shape) <= 3)
-        if len(image.shape) == 2:  # gray scale
-            h, w = image.shape
-            self.qimage = \
-                QtGui.QImage(image.data, w, h, w, QtGui.QImage.Format_Indexed8)
-        elif len(image.shape) == 3:  # others
-            h, w, d = image.shape
-            self.qimage = \
-                QtGui.QImage(image.data, w, h, w*d, QtGui.QImage.Format_RGB888)
-
-        self.pixmap = QtGui.QPixmap.fromImage(self.qimage)
-        self.pixitem.setPixmap(self.pixmap)
-
-    def excute_image_processing(self, root, module):
-        img_index = int(root.find('common').find('picture_number').text)
-        cnt_index = int(root.find('common').find('contour_number').text)
-        obj_img = self.image_list[img_index]
-        obj_cnt = self.image_list[cnt_index]
-
-        if obj_img is None or obj_cnt is None or module is None:
-            raise error.ModuleError('input image or contours is None!')
+            self.capturer.release(job.frame_id)
+        self.show_status()
+        if 0.5 < time.time() - self.profile_time:
+            self.profile_time = time.time()
+            self.show_profile()
+
+    def show_profile(self):
+        # p50/p95/p99 of each stage next to its name in the toolbox
+        for (index, form) in enumerate(self.form_list):
+            text = form.get_name()
+            stats = self.profiler.get_stats(index)
+            if stats is not None:
+                text += '  [%.1f / %.1f / %.1f ms]' % (
+                    stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+            self.toolBox.setItemText(index, text)
+
+    def export_timing(self):
+        filename_list = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Export Timing', self.dirname,
+            'CSV files (*.csv);;JSON files (*.json)')
+        if len(filename_list[0]) == 0:
+            return
+        self.profiler.export(filename_list[0])
 
-        return module.get_image(root, obj_img, obj_cnt)
+    def select_roi(self, rect, from_point, to_point):
+        # called while dragging, and with a null rect when the drag ends
+        if not rect.isNull():
+            self.roi_points = (from_point, to_point)
+            return
+        if self.roi_points is None or self.pipeline.committed_frame is None:
+            return
+        from_point, to_point = self.roi_points
+        self.roi_points = None
+        x0, x1 = sorted([from_point.x(), to_point.x()])
+        y0, y1 = sorted([from_point.y(), to_point.y()])
+        if len(self.source_list) != 0:
+            # the first tile is the frame scaled down to tile_size
+            height, width = self.pipeline.committed_frame.image.shape[:2]
+            sx = float(width) / self.tile_size[0]
+            sy = float(height) / self.tile_size[1]
+            x0, x1, y0, y1 = x0*sx, x1*sx, y0*sy, y1*sy
+        roi = [int(x0), int(y0), int(x1-x0), int(y1-y0)]
+        if roi[2] < 4 or roi[3] < 4:
+            return  # a click, not a region
+        self.form_list[0].set_roi(roi)
+
+    def to_frame_image(self, obj):
+        # a region of interest result pasted back into its frame
+        frame = ip.to_bgr(self.pipeline.committed_frame)
+        if self.roi_canvas is None or self.roi_canvas.shape != frame.shape:
+            self.roi_canvas = np.empty_like(frame)
+        np.copyto(self.roi_canvas, frame)
+        image = ip.to_bgr(obj)
+        if len(image.shape) == 2:
+            image = image[:, :, np.newaxis]
+        x, y = obj.offset
+        h, w = image.shape[:2]
+        self.roi_canvas[y:y+h, x:x+w] = image
+        cv2.rectangle(self.roi_canvas, (x, y), (x+w-1, y+h-1),
+                      (0, 255, 255), 1)
+        return ip.ImageObj(self.roi_canvas, ip.CvtColor.Codes.BGR)
+
+    def select_image(self):
+        self.show_image()
+
+    def sweep_parameters(self):
+        # sweeps the stage selected in the toolbox on the shown frame
+        index = self.toolBox.currentIndex()
+        if index <= 0 or self.shown_frame_id is None:
+            return
+        stage = self.pipeline.stages[index]
+        if stage is None:
+            return
+        text, ok = QtWidgets.QInputDialog.getText(
+            self, 'Parameter Sweep',
+            'name=start:stop:step or name=v1,v2,... separated by ;\n'
+            'parameters: ' + ', '.join(stage.params._fields),
+            text=sweep.default_grids.get(stage.module.name, ''))
+        if not ok:
+            return
+        try:
+            grid = sweep.parse_grid(str(text), stage.params)
+        except (error.ModuleError, ValueError) as e:
+            QtWidgets.QMessageBox.warning(self, 'Parameter Sweep', str(e))
+            return
+        bases = sweep.ParameterSweep.prepare_bases(self.pipeline)
+        job = sweep.ParameterSweep(
+            bases, index, grid, self.comboBoxSelectImages.currentIndex())
+        # the frame must stay while the sweep reads it
+        self.capturer.retain(self.shown_frame_id)
+        thread = threading.Thread(target=self.run_sweep,
+                                  args=(self.shown_frame_id, job))
+        thread.daemon = True
+        thread.start()
+
+    def run_sweep(self, frame_id, job):
+        results = None
+        try:
+            results = job.run()
+        except Exception:
+            traceback.print_exc()
+        self.sigSweepDone.emit((frame_id, results))
+
+    def show_sweep(self, args):
+        frame_id, results = args
+        self.capturer.release(frame_id)
+        if not results:
+            return
+        sheet = sweep.ParameterSweep.contact_sheet(results)
+        rgb = np.ascontiguousarray(sheet[:, :, ::-1])
+        h, w = rgb.shape[:2]
+        qimage = QtGui.QImage(rgb.data, w, h, w * 3,
+                              QtGui.QImage.Format_RGB888).copy()
+        label = QtWidgets.QLabel()
+        label.setPixmap(QtGui.QPixmap.fromImage(qimage))
+        scroll = QtWidgets.QScrollArea()
+        scroll.setWidget(label)
+        dialog = QtWidgets.QDialog(self)
+        dialog.setWindowTitle('Parameter Sweep')
+        dialog.setLayout(QtWidgets.QVBoxLayout())
+        dialog.layout().addWidget(scroll)
+        dialog.resize(min(w + 40, 1200), min(h + 40, 800))
+        dialog.show()
+
+    def show_image(self):
+        # only the image selected in comboBoxSelectImages is converted
+        image_list = self.pipeline.results
+        index = self.comboBoxSelectImages.currentIndex()
+        if self.pipeline.committed_frame is None:
+            return
+        elif len(image_list) == 0 or image_list[-1] is None:
+            obj = self.pipeline.committed_frame
+        elif image_list[index] is None:
+            obj = self.pipeline.committed_frame
+        else:
+            obj = image_list[index]
+        if obj.offset is not None:
+            obj = self.to_frame_image(obj)
+        if len(self.source_list) == 0:
+            self.display.set_image(obj)
+            return
+        images = [ip.to_bgr(obj)]
+        for tile in self.tile_list:
+            images.append(None if tile is None else tile[1])
+        canvas = self.canvas.compose(images)
+        self.display.set_image(ip.ImageObj(canvas, ip.CvtColor.Codes.BGR))
 
 
 def main():
+    # python main.py [source ...], a source is a camera index, a video file
+    # or 'synthetic' (default: camera 0). the extra sources are started
+    # before Qt, so their processes do not inherit it
+    spec_list = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if len(spec_list) == 0:
+        spec_list = ['0']
+    source_list = [sources.SourceProcess(number, spec, MainForm.tile_size)
+                   for (number, spec) in enumerate(spec_list[1:], 1)]
+    for source in source_list:
+        source.start()
     app = QtWidgets.QApplication(sys.argv)
-    form = MainForm()
+    form = MainForm(spec_list[0], source_list)
     app.exec_()
 
 if __name__ == '__main__':
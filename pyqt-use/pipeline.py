@@ -0,0 +1,205 @@
+import copy
+import itertools
+import time
+from datetime import datetime
+
+import error
+import imageprocess as ip
+
+
+class Pipeline():
+    # chain of compiled stages with per-stage result cache
+    #
+    # every cached result remembers the key it was computed from, that is
+    # the stage itself and the serial numbers of its picture/contour inputs.
+    # a stage is re-executed only when this key changes, so editing a form or
+    # setting a new frame re-runs just the stages downstream of the change.
+    #
+    # execution works on a snapshot (Job) taken by prepare(), so it may run
+    # on another thread; commit() adopts the results of the newest job.
+    def __init__(self):
+        self.counter = itertools.count(1)
+        self.structure = 0
+        self.committed_seq = 0
+        self.committed_frame = None
+        self.frame = None
+        self.frame_id = None
+        self.frame_serial = None
+        self.stages = []
+        self.results = []
+        self.keys = []
+        self.serials = []
+        # output buffers of each stage, kept across frames
+        self.buffers = []
+
+    def close_stage(self, stage, keep=None):
+        # the module of a dropped stage is closed unless it is still used
+        if stage is not None and stage.module is not keep:
+            ip.close_module(stage.module)
+
+    def clear(self, keep=()):
+        # modules in keep are going to be used again
+        self.structure += 1
+        for stage in self.stages:
+            if stage is not None and \
+                    not any(stage.module is module for module in keep):
+                self.close_stage(stage)
+        del self.buffers[:]
+        del self.stages[:]
+        del self.results[:]
+        del self.keys[:]
+        del self.serials[:]
+
+    def insert(self, index, stage):
+        self.structure += 1
+        self.buffers.insert(index, ip.BufferPool())
+        self.stages.insert(index, stage)
+        self.results.insert(index, None)
+        self.keys.insert(index, None)
+        self.serials.insert(index, None)
+
+    def remove(self, index):
+        self.structure += 1
+        self.close_stage(self.stages[index])
+        del self.buffers[index]
+        del self.stages[index]
+        del self.results[index]
+        del self.keys[index]
+        del self.serials[index]
+
+    def set_stage(self, index, stage):
+        old = self.stages[index]
+        self.stages[index] = stage
+        self.close_stage(old, None if stage is None else stage.module)
+
+    def set_frame(self, frame, frame_id=None):
+        self.frame = frame
+        self.frame_id = frame_id
+        self.frame_serial = next(self.counter)
+
+    def prepare(self):
+        return Job(self)
+
+    def prepare_committed(self):
+        # job on the committed frame and results, e.g. to re-run some stages
+        # with other parameters; it is never committed itself
+        job = Job(self)
+        job.frame = self.committed_frame
+        job.frame_id = None
+        if len(self.keys) != 0 and self.keys[0] is not None:
+            job.frame_serial = self.keys[0][1]
+        return job
+
+    def commit(self, job):
+        # results of a job are dropped when a newer job was committed already
+        # or when stages were inserted/removed while it was running
+        if job.seq < self.committed_seq or job.structure != self.structure:
+            job.committed = False
+            return False
+        self.committed_seq = job.seq
+        self.committed_frame = job.frame
+        self.results = job.results
+        self.keys = job.keys
+        self.serials = job.serials
+        job.committed = True
+        return True
+
+    def run(self):
+        # returns the number of executed stages
+        job = self.prepare()
+        job.run()
+        self.commit(job)
+        return job.count
+
+
+class Job():
+    def __init__(self, pipeline):
+        self.seq = next(pipeline.counter)
+        self.counter = pipeline.counter
+        self.structure = pipeline.structure
+        self.frame = pipeline.frame
+        self.frame_id = pipeline.frame_id
+        self.frame_serial = pipeline.frame_serial
+        self.stages = list(pipeline.stages)
+        self.buffers = list(pipeline.buffers)
+        self.results = list(pipeline.results)
+        self.keys = list(pipeline.keys)
+        self.serials = list(pipeline.serials)
+        self.count = 0
+        # execution time [s], output size [byte] and number of allocated
+        # buffers of each stage, None if it was not executed
+        self.times = [None] * len(self.stages)
+        self.sizes = [None] * len(self.stages)
+        self.allocations = [None] * len(self.stages)
+        self.prepare_time = time.time()
+        self.failed = False
+        self.committed = False
+
+    def set_frame(self, frame, frame_id=None):
+        self.frame = frame
+        self.frame_id = frame_id
+        self.frame_serial = next(self.counter)
+
+    def fork(self):
+        # independent copy of the current state, sharing the results
+        job = copy.copy(self)
+        job.seq = next(self.counter)
+        for name in ['stages', 'buffers', 'results', 'keys', 'serials']:
+            setattr(job, name, list(getattr(self, name)))
+        job.count = 0
+        job.times = [None] * len(self.stages)
+        job.sizes = [None] * len(self.stages)
+        job.allocations = [None] * len(self.stages)
+        return job
+
+    def get_input(self, index, number):
+        # the first stage (input) always reads the captured frame
+        if index == 0:
+            return (self.frame, self.frame_serial)
+        elif 0 <= number < index:
+            return (self.results[number], self.serials[number])
+        else:
+            return (None, None)
+
+    def get_key(self, index, stage):
+        if stage is None:
+            return (None, None, None, None)
+        _, img_serial = self.get_input(index, stage.picture_number)
+        _, cnt_serial = self.get_input(index, stage.contour_number)
+        # modules completing work asynchronously (e.g. Pyocr) bump revision
+        revision = getattr(stage.module, 'revision', None)
+        return (stage, img_serial, cnt_serial, revision)
+
+    def run(self):
+        for (index, stage) in enumerate(self.stages):
+            key = self.get_key(index, stage)
+            if key == self.keys[index]:
+                continue
+            self.keys[index] = key
+            self.serials[index] = next(self.counter)
+            self.count += 1
+            allocations = self.buffers[index].allocations
+            start_time = time.time()
+            try:
+                self.results[index] = \
+                    self.excute_image_processing(index, stage)
+            except error.ModuleError as e:
+                print e, datetime.now()
+                self.results[index] = None
+            self.times[index] = time.time() - start_time
+            self.allocations[index] = \
+                self.buffers[index].allocations - allocations
+            result = self.results[index]
+            self.sizes[index] = 0 if result is None else result.image.nbytes
+        return self
+
+    def excute_image_processing(self, index, stage):
+        if stage is None:
+            raise error.ModuleError('stage is not compiled!')
+        obj_img, _ = self.get_input(index, stage.picture_number)
+        obj_cnt, _ = self.get_input(index, stage.contour_number)
+
+        if obj_img is None or obj_cnt is None:
+            raise error.ModuleError('input image or contours is None!')
+
+        return stage.get_image(obj_img, obj_cnt, self.buffers[index])
@@ -0,0 +1,62 @@
+import collections
+import json
+
+import numpy as np
+
+
+class StageProfiler():
+    # rolling per-stage statistics of committed pipeline jobs
+    #
+    # only executed stages are recorded (cached ones cost nothing), the
+    # statistics are reset whenever the chain of stage names changes.
+    percentiles = [50, 95, 99]
+
+    def __init__(self, window=100):
+        self.window = window
+        self.names = []
+        self.samples = []
+
+    def record(self, job, names):
+        if names != self.names:
+            self.names = list(names)
+            self.samples = [collections.deque(maxlen=self.window)
+                            for _ in names]
+        for (index, t) in enumerate(job.times):
+            if t is None or index >= len(self.samples):
+                continue
+            self.samples[index].append(
+                (t, job.sizes[index], job.allocations[index]))
+
+    def get_stats(self, index):
+        # returns None if the stage has not been executed yet
+        if index >= len(self.samples) or len(self.samples[index]) == 0:
+            return None
+        samples = np.array(self.samples[index], dtype=np.float64)
+        times = np.percentile(samples[:, 0], self.percentiles)
+        return collections.OrderedDict([
+            ('index', index),
+            ('name', self.names[index]),
+            ('count', len(samples)),
+            ('p50_ms', times[0] * 1000),
+            ('p95_ms', times[1] * 1000),
+            ('p99_ms', times[2] * 1000),
+            ('mean_bytes', samples[:, 1].mean()),
+            ('mean_allocations', samples[:, 2].mean()),
+            ])
+
+    def get_all_stats(self):
+        all_stats = [self.get_stats(i) for i in range(len(self.names))]
+        return [stats for stats in all_stats if stats is not None]
+
+    def export(self, filename):
+        all_stats = self.get_all_stats()
+        if filename.lower().endswith('.json'):
+            with open(filename, 'w') as file:
+                json.dump(all_stats, file, indent=2)
+            return
+        keys = ['index', 'name', 'count', 'p50_ms', 'p95_ms', 'p99_ms',
+                'mean_bytes', 'mean_allocations']
+        with open(filename, 'w') as file:
+            file.write(','.join(keys) + '\n')
+            for stats in all_stats:
+                file.write(','.join(str(stats[key]) for key in keys) + '\n')
@@ -0,0 +1,79 @@
+import os
+import json
+from xml.etree import ElementTree
+
+# pipeline files are stored either as xml (<top> with one <module> per stage)
+# or, with a .json extension, as the same tree in compact json:
+#
+#   {"modules": [{"name": "Canny",
+#                 "common": {"picture_number": "0", "contour_number": "0"},
+#                 "threshold1": "100", ...}, ...]}
+#
+# both are read into the same ElementTree, so forms and load_stages() work
+# on either.
+
+
+def is_json(filename):
+    return os.path.splitext(filename)[1].lower() == '.json'
+
+
+def element_to_dict(root):
+    # leaves become their text, elements with children nested dicts
+    d = {}
+    for key, value in root.attrib.items():
+        d[key] = value
+    for child in root:
+        if len(child):
+            d[child.tag] = element_to_dict(child)
+        else:
+            d[child.tag] = child.text
+    return d
+
+
+def dict_to_element(tag, d, attributes=('name',)):
+    root = ElementTree.Element(tag)
+    for key, value in sorted(d.items()):
+        if key in attributes:
+            root.set(key, value)
+        elif isinstance(value, dict):
+            root.append(dict_to_element(key, value, ()))
+        else:
+            elem = ElementTree.SubElement(root, key)
+            elem.text = None if value is None else str(value)
+    return root
+
+
+def indent(elem, level=0):
+    # pretty printing in place, instead of a round-trip through minidom
+    space = '\n' + '  ' * level
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = space + '  '
+        for child in elem:
+            indent(child, level+1)
+        if not child.tail or not child.tail.strip():
+            child.tail = space
+    if level and (not elem.tail or not elem.tail.strip()):
+        elem.tail = space
+
+
+def load(filename):
+    if not is_json(filename):
+        return ElementTree.parse(filename).getroot()
+    with open(filename) as file:
+        data = json.load(file)
+    root_top = ElementTree.Element('top')
+    for d in data['modules']:
+        root_top.append(dict_to_element('module', d))
+    return root_top
+
+
+def save(filename, root_top):
+    if is_json(filename):
+        data = {'modules': [element_to_dict(root_module)
+                            for root_module in root_top.findall('module')]}
+        with open(filename, 'w') as file:
+            json.dump(data, file, separators=(',', ':'), sort_keys=True)
+        return
+    indent(root_top)
+    ElementTree.ElementTree(root_top).write(filename, 'utf-8', True)
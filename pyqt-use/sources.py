@@ -0,0 +1,141 @@
+import Queue
+import multiprocessing
+from xml.etree import ElementTree
+import cv2
+
+import imageprocess as ip
+import capture
+import pipeline
+
+
+class SourceProcess(multiprocessing.Process):
+    # one additional video source with its own capture worker and its own
+    # copy of the stage chain, running in a separate process
+    #
+    # the GUI sends the whole pipeline (as xml text) when stages are inserted
+    # or removed, a single stage when it is edited, and the index of the
+    # stage to show. module instances are kept across these, so state such
+    # as a trained kNN or OCR workers is not rebuilt on every edit.
+    # the process sends back the result of the stage to show
+    # of every frame, already scaled down to the tile size. only the newest
+    # tile matters, so tiles are dropped while the GUI lags behind.
+    def __init__(self, number, spec, tile_size):
+        super(SourceProcess, self).__init__()
+        self.daemon = True
+        self.number = number
+        self.spec = spec
+        self.tile_size = tile_size
+        self.commands = multiprocessing.Queue()
+        self.tiles = multiprocessing.Queue(maxsize=2)
+
+    def set_pipeline(self, root_top):
+        self.commands.put(('pipeline', ElementTree.tostring(root_top)))
+
+    def set_stage(self, index, root_module):
+        self.commands.put(('stage', index, ElementTree.tostring(root_module)))
+
+    def set_output(self, index):
+        self.commands.put(('output', index))
+
+    def quit(self):
+        self.commands.put(None)
+
+    def get_tile(self):
+        # newest (frame_id, tile, times, counters) or None
+        tile = None
+        while True:
+            try:
+                tile = self.tiles.get_nowait()
+            except Queue.Empty:
+                return tile
+
+    def run(self):
+        cap = capture.open_source(self.spec)
+        capturer = capture.CaptureWorker(cap, size=4)
+        capturer.start()
+        self.pipeline = pipeline.Pipeline()
+        self.output = -1
+        frame_id = None
+        try:
+            while self.read_commands():
+                new_id, image = capturer.latest(timeout=1.0)
+                if new_id is None:
+                    continue
+                if new_id == frame_id:
+                    # nothing new yet, the same frame is held twice now
+                    capturer.release(new_id)
+                    capturer.quit_event.wait(0.005)
+                    continue
+                self.process(ip.ImageObj(image, ip.CvtColor.Codes.BGR),
+                             new_id, capturer.get_counters())
+                # cached results may refer to the previous frame until now
+                if frame_id is not None:
+                    capturer.release(frame_id)
+                frame_id = new_id
+        finally:
+            capturer.quit()
+            capturer.join()
+            cap.release()
+
+    def read_commands(self):
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except Queue.Empty:
+                return True
+            if command is None:
+                return False
+            if command[0] == 'pipeline':
+                self.load_pipeline(ElementTree.fromstring(command[1]))
+            elif command[0] == 'stage':
+                self.compile_stage(command[1],
+                                   ElementTree.fromstring(command[2]))
+            elif command[0] == 'output':
+                self.output = command[1]
+
+    def load_pipeline(self, root_top):
+        # modules are reused in order by class, so inserting or removing a
+        # stage does not rebuild the others
+        unused = {}
+        for stage in self.pipeline.stages:
+            if stage is not None:
+                unused.setdefault(stage.module.name, []).append(stage.module)
+        modules = []
+        for root_module in root_top.findall('module'):
+            name = ip.get_module_class(root_module.get('name')).name
+            if len(unused.get(name, [])) != 0:
+                modules.append(unused[name].pop(0))
+            else:
+                modules.append(ip.create_module(root_module.get('name'),
+                                                lazy=True))
+        self.pipeline.clear(keep=modules)
+        for (index, (module, root_module)) in enumerate(
+                zip(modules, root_top.findall('module'))):
+            self.pipeline.insert(index, ip.compile_stage(module, root_module))
+
+    def compile_stage(self, index, root_module):
+        if not 0 <= index < len(self.pipeline.stages):
+            return
+        stage = self.pipeline.stages[index]
+        if stage is None:
+            module = ip.create_module(root_module.get('name'), lazy=True)
+        else:
+            module = stage.module
+        self.pipeline.set_stage(index, ip.compile_stage(module, root_module))
+
+    def process(self, frame, frame_id, counters):
+        self.pipeline.set_frame(frame, frame_id)
+        job = self.pipeline.prepare()
+        job.run()
+        self.pipeline.commit(job)
+        obj = None
+        if -len(job.results) <= self.output < len(job.results):
+            obj = job.results[self.output]
+        if obj is None:
+            obj = frame
+        tile = cv2.resize(ip.to_bgr(obj), self.tile_size,
+                          interpolation=cv2.INTER_AREA)
+        try:
+            self.tiles.put_nowait((frame_id, tile, job.times, counters))
+        except Queue.Full:
+            pass
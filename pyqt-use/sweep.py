@@ -0,0 +1,223 @@
+# parameter sweep of one pipeline stage
+#
+#   python sweep.py test.xml frame.png -s 2 -g "min_val=0:200:50"
+#   python sweep.py test.xml movie.avi -s 2 -n 10 -o sheet.png
+#
+# every combination of the grid is run on the same frame(s). the results of
+# the stages before the swept one are computed once and shared, so only the
+# swept stage and the stages after it run per combination. the combinations
+# are spread over threads (OpenCV releases the GIL).
+
+import sys
+import time
+import argparse
+import itertools
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import cv2
+import numpy as np
+
+import error
+import imageprocess as ip
+import pipeline
+import project
+
+# grids offered for the stages people tune most
+default_grids = {ip.Canny.name: 'min_val=0:200:50; max_val=100:300:100',
+                 ip.Thresh.name: 'thresh=0:255:32',
+                 ip.AdaptThresh.name: 'bs=3,5,11,21,31; p1=0:10:2'}
+
+
+def parse_grid(text, params):
+    # 'name=start:stop:step; name=v1,v2,...' into an OrderedDict of value
+    # lists, names are fields of the stage's Params
+    grid = collections.OrderedDict()
+    for item in text.split(';'):
+        if not item.strip():
+            continue
+        name, _, values = item.partition('=')
+        name = name.strip()
+        if name not in params._fields:
+            raise error.ModuleError('unknown parameter: ' + name)
+        if ':' in values:
+            start, stop, step = [int(v) for v in values.split(':')]
+            grid[name] = range(start, stop+1, step)
+        else:
+            grid[name] = [int(v) for v in values.split(',')]
+    if len(grid) == 0:
+        raise error.ModuleError('empty parameter grid')
+    return grid
+
+
+class ParameterSweep():
+    thumb_size = (160, 120)
+
+    def __init__(self, bases, index, grid, output_index=-1, workers=None):
+        # bases: jobs whose results up to the swept stage are up to date,
+        # one per frame (see prepare_bases)
+        self.bases = bases
+        self.index = index
+        self.grid = grid
+        self.output_index = output_index
+        self.workers = workers or multiprocessing.cpu_count()
+
+    @staticmethod
+    def prepare_bases(pipe, frames=None):
+        # with no frames the committed frame of pipe, as it is cached
+        if frames is None:
+            return [pipe.prepare_committed().run()]
+        bases = []
+        for frame in frames:
+            job = pipe.prepare()
+            job.set_frame(frame)
+            bases.append(job.run())
+        return bases
+
+    def get_combinations(self):
+        names = self.grid.keys()
+        return [collections.OrderedDict(zip(names, values))
+                for values in itertools.product(*self.grid.values())]
+
+    def run_one(self, values):
+        # mean time of the re-run stages over the frames, and a thumbnail of
+        # the output for the first frame. a combination OpenCV rejects (e.g.
+        # an even blockSize) gets time None and a failed thumbnail, the
+        # other combinations are still run
+        times = []
+        thumb = None
+        for base in self.bases:
+            job = base.fork()
+            stage = job.stages[self.index]
+            job.stages[self.index] = \
+                stage._replace(params=stage.params._replace(**values))
+            # own buffers, the results of the pipeline are still in use
+            for i in range(self.index, len(job.stages)):
+                job.buffers[i] = ip.BufferPool()
+            try:
+                job.run()
+            except cv2.error as e:
+                print 'failed:', dict(values), str(e).strip()
+                return (values, None, self.get_failed_thumb())
+            times.append(sum(t for t in job.times[self.index:]
+                             if t is not None))
+            if thumb is None:
+                thumb = self.get_thumb(job.results[self.output_index])
+        return (values, np.mean(times), thumb)
+
+    def get_failed_thumb(self):
+        thumb = np.zeros(self.thumb_size[::-1] + (3,), np.uint8)
+        thumb[:] = (0, 0, 96)
+        cv2.putText(thumb, 'error', (self.thumb_size[0]//2 - 24,
+                                     self.thumb_size[1]//2),
+                    cv2.FONT_HERSHEY_PLAIN, 1.2, (255, 255, 255))
+        return thumb
+
+    def get_thumb(self, obj):
+        if obj is None:
+            return np.zeros(self.thumb_size[::-1] + (3,), np.uint8)
+        image = cv2.resize(ip.to_bgr(obj), self.thumb_size,
+                           interpolation=cv2.INTER_AREA)
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return image
+
+    def run(self):
+        # list of (values, mean time [s] or None if failed, thumbnail) in
+        # grid order
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(self.run_one, self.get_combinations())
+        finally:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def contact_sheet(cls, results, columns=6):
+        # thumbnails in a grid, each captioned with its values and time
+        w, h = cls.thumb_size
+        caption = 28
+        columns = min(columns, len(results))
+        rows = (len(results) + columns - 1) // columns
+        sheet = np.zeros((rows * (h + caption), columns * w, 3), np.uint8)
+        for (i, (values, t, thumb)) in enumerate(results):
+            row, column = divmod(i, columns)
+            x, y = column * w, row * (h + caption)
+            sheet[y:y+h, x:x+w] = thumb
+            text = ' '.join('%s=%s' % item for item in values.items())
+            cv2.putText(sheet, text, (x+2, y+h+12),
+                        cv2.FONT_HERSHEY_PLAIN, 0.8, (255, 255, 255))
+            if t is None:
+                cv2.putText(sheet, 'failed', (x+2, y+h+24),
+                            cv2.FONT_HERSHEY_PLAIN, 0.8, (0, 0, 255))
+            else:
+                cv2.putText(sheet, '%.2f ms' % (t*1000), (x+2, y+h+24),
+                            cv2.FONT_HERSHEY_PLAIN, 0.8, (0, 255, 255))
+        return sheet
+
+
+def read_frames(source, count):
+    image = cv2.imread(source)
+    if image is not None:
+        return [image]
+    frames = []
+    capture = cv2.VideoCapture(source)
+    while len(frames) < count:
+        success, image = capture.read()
+        if not success:
+            break
+        frames.append(image)
+    capture.release()
+    return frames
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='sweep stage parameters')
+    parser.add_argument('pipeline', help='pipeline file saved by main.py')
+    parser.add_argument('source', help='image or video file')
+    parser.add_argument('-s', '--stage', type=int, required=True,
+                        help='index of stage to sweep')
+    parser.add_argument('-g', '--grid', default=None,
+                        help='parameter grid (default: per stage type)')
+    parser.add_argument('-n', '--frames', type=int, default=1,
+                        help='number of video frames')
+    parser.add_argument('-o', '--output', default='sweep.png',
+                        help='contact sheet image')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker threads')
+    args = parser.parse_args(argv)
+
+    ip.Pyocr.workers = 0
+    pipe = pipeline.Pipeline()
+    for (index, stage) in enumerate(ip.load_stages(
+            project.load(args.pipeline))):
+        pipe.insert(index, stage)
+    stage = pipe.stages[args.stage]
+    text = args.grid or default_grids.get(stage.module.name)
+    if text is None:
+        print 'no default grid for', stage.module.name
+        return
+    grid = parse_grid(text, stage.params)
+    frames = [ip.ImageObj(image, ip.CvtColor.Codes.BGR)
+              for image in read_frames(args.source, args.frames)]
+    if len(frames) == 0:
+        print 'no frames:', args.source
+        return
+
+    start_time = time.time()
+    bases = ParameterSweep.prepare_bases(pipe, frames)
+    sweep = ParameterSweep(bases, args.stage, grid, workers=args.jobs)
+    results = sweep.run()
+    print '%d combinations, %d frames, %.1f s' % (
+        len(results), len(frames), time.time() - start_time)
+    # fastest first, failed combinations last
+    for (values, t, _) in sorted(results, key=lambda r: (r[1] is None, r[1])):
+        if t is None:
+            print '%s, failed' % dict(values)
+        else:
+            print '%s, %.3f ms' % (dict(values), t*1000)
+    cv2.imwrite(args.output, ParameterSweep.contact_sheet(results))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Flowchart execution engine
+"""
+
+import os
+import sys
+import time
+import threading
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5 import QtCore
+
+
+class EngineNode(object):
+    """
+    This is mixin for nodes evaluated by FlowchartEngine
+
+    while an engine drives the flowchart, update() (called by pyqtgraph when
+    controls or connections change) asks the engine to evaluate the graph
+    again instead of processing on the spot.
+    nodes with gui_thread = True are processed on the GUI thread.
+    """
+    engine = None
+    gui_thread = False
+
+    def update(self, signal=True):
+        if self.engine is None:
+            return super().update(signal)
+        self.engine.refresh()
+
+
+class Job(object):
+    """
+    This is Job
+    1回分の入力に対するノードグラフの評価
+    """
+    def __init__(self, seq, inputs, plan):
+        self.seq = seq
+        self.inputs = inputs
+        self.plan = plan
+        self.lock = threading.Lock()
+        # output terminal -> value
+        self.values = dict(plan.input_values(inputs))
+        self.remaining = {node: len(deps) for node, deps in plan.deps.items()}
+        self.left = len(plan.deps)
+        self.display = []   # (node, args) to process on the GUI thread
+        self.errors = []    # (node, exc_info)
+
+
+class Plan(object):
+    """
+    This is Plan
+    GUIスレッドで取得したノードグラフのスナップショット
+    """
+    def __init__(self, flowchart):
+        self.input_node = flowchart.inputNode
+        self.output_node = flowchart.outputNode
+        self.input_terms = dict(self.input_node.outputs())
+        self.args = {}          # node -> [(input name, [output terminal], multi)]
+        self.outputs = {}       # node -> [(output name, output terminal)]
+        self.deps = {}          # node -> set of upstream nodes
+        self.dependents = {}    # node -> list of downstream nodes
+        self.bypassed = {}
+        self.gui_thread = {}
+        for node in flowchart.nodes().values():
+            if node is self.input_node or node is self.output_node:
+                continue
+            args = []
+            deps = set()
+            for name, term in node.inputs().items():
+                sources = term.inputTerminals()
+                args.append((name, sources, term.isMultiValue()))
+                deps.update(s.node() for s in sources
+                            if s.node() is not self.input_node)
+            self.args[node] = args
+            self.outputs[node] = list(node.outputs().items())
+            self.deps[node] = deps
+            self.bypassed[node] = node.isBypassed()
+            self.gui_thread[node] = getattr(node, 'gui_thread', False)
+        for node in self.deps:
+            self.dependents[node] = []
+        for node, deps in self.deps.items():
+            # nodes feeding only the flowchart output are not evaluated
+            self.deps[node] = deps = set(d for d in deps if d in self.deps)
+            for dep in deps:
+                self.dependents[dep].append(node)
+
+    def input_values(self, inputs):
+        for name, term in self.input_terms.items():
+            yield (term, inputs.get(name))
+
+
+class FlowchartEngine(QtCore.QObject):
+    """
+    This is Flowchart Engine
+    フローチャートのノードグラフをワーカースレッドで評価する
+
+    nodes are processed on a thread pool as soon as all of their inputs are
+    available, so independent branches run concurrently (OpenCV releases the
+    GIL). view nodes are processed on the GUI thread once the job is done.
+    at most max_jobs inputs are evaluated at a time, further inputs wait in a
+    bounded queue and the oldest one is dropped when it is full.
+    """
+    sigJobDone = QtCore.pyqtSignal(object)
+    sigJobFinished = QtCore.pyqtSignal(object, bool)  # job, shown
+
+    def __init__(self, flowchart, workers=None, max_jobs=2, queue_size=1):
+        super().__init__()
+        self.flowchart = flowchart
+        self.executor = ThreadPoolExecutor(workers or os.cpu_count() or 2)
+        self.max_jobs = max_jobs
+        self.queue = collections.deque(maxlen=queue_size)
+        self.jobs = 0
+        self.seq = 0
+        self.shown_seq = 0
+        self.dropped = 0
+        self.last_inputs = None
+        self.refresh_pending = False
+        # emitted from the pool thread, delivered on the GUI thread
+        self.sigJobDone.connect(self.finish)
+
+        for node in flowchart.nodes().values():
+            self.attach(node)
+        flowchart.sigChartChanged.connect(self.chart_changed)
+
+    def attach(self, node):
+        if isinstance(node, EngineNode):
+            node.engine = self
+
+    def chart_changed(self, flowchart, action, node):
+        if action == 'add':
+            self.attach(node)
+        elif action == 'remove' and isinstance(node, EngineNode):
+            node.engine = None
+        self.refresh()
+
+    def set_queue_size(self, size):
+        self.queue = collections.deque(self.queue, maxlen=size)
+
+    def is_busy(self):
+        return self.jobs >= self.max_jobs
+
+    def submit(self, **inputs):
+        """
+        evaluate the flowchart for the values of its input terminals
+        """
+        self.last_inputs = inputs
+        if self.jobs >= self.max_jobs:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(inputs)
+            return
+        self.start(inputs)
+
+    def refresh(self):
+        # evaluate the last inputs again (node or chart changed), at most
+        # once per event loop iteration
+        if self.refresh_pending or self.last_inputs is None:
+            return
+        self.refresh_pending = True
+        QtCore.QTimer.singleShot(0, self._refresh)
+
+    def _refresh(self):
+        self.refresh_pending = False
+        if self.jobs >= self.max_jobs:
+            if self.last_inputs not in self.queue:
+                self.queue.append(self.last_inputs)
+            return
+        self.start(self.last_inputs)
+
+    def start(self, inputs):
+        self.seq += 1
+        self.jobs += 1
+        job = Job(self.seq, inputs, Plan(self.flowchart))
+        if job.left == 0:
+            self.sigJobDone.emit(job)
+            return
+        for node, deps in job.plan.deps.items():
+            if len(deps) == 0:
+                self.executor.submit(self.run_node, job, node)
+
+    def run_node(self, job, node):
+        plan = job.plan
+        try:
+            args = {}
+            with job.lock:
+                for name, sources, multi in plan.args[node]:
+                    if multi:
+                        args[name] = {s: job.values.get(s) for s in sources}
+                    elif len(sources) == 0:
+                        args[name] = None
+                    else:
+                        args[name] = job.values.get(sources[0])
+            if plan.gui_thread[node]:
+                out = None
+                with job.lock:
+                    job.display.append((node, args))
+            elif plan.bypassed[node]:
+                out = node.processBypassed(args)
+            else:
+                out = node.process(display=False, **args)
+        except Exception:
+            out = None
+            with job.lock:
+                job.errors.append((node, sys.exc_info()))
+
+        ready = []
+        with job.lock:
+            for name, term in plan.outputs[node]:
+                job.values[term] = None if out is None else out.get(name)
+            for dependent in plan.dependents[node]:
+                job.remaining[dependent] -= 1
+                if job.remaining[dependent] == 0:
+                    ready.append(dependent)
+            job.left -= 1
+            done = job.left == 0
+        for dependent in ready:
+            self.executor.submit(self.run_node, job, dependent)
+        if done:
+            self.sigJobDone.emit(job)
+
+    def finish(self, job):
+        self.jobs -= 1
+        for node, exc_info in job.errors:
+            traceback.print_exception(*exc_info)
+            node.setException(exc_info)
+        # a job finishing after a newer one must not overwrite its display
+        shown = job.seq > self.shown_seq
+        if shown:
+            self.shown_seq = job.seq
+            for node, args in job.display:
+                try:
+                    node.process(display=True, **args)
+                    node.clearException()
+                except Exception:
+                    node.setException(sys.exc_info())
+        while self.jobs < self.max_jobs and len(self.queue) != 0:
+            self.start(self.queue.popleft())
+        self.sigJobFinished.emit(job, shown)
+
+    def close(self):
+        self.queue.clear()
+        self.executor.shutdown(wait=True)
+
+
+class FrameDispatcher(QtCore.QObject):
+    """
+    This is Frame Dispatcher
+    インポータからフローチャートへのフレーム受け渡し
+
+    put() may be called from any thread (connect importer signals with
+    Qt.DirectConnection). for each flowchart input only the newest depth
+    frames are kept, older ones are dropped and counted, and a single wakeup
+    per batch is posted to the GUI thread, so a fast source can not flood the
+    Qt event queue. frames are handed to the engine only while it has room
+    for a new job, together with the last frame of every other input.
+    """
+    sigPending = QtCore.pyqtSignal()
+    sigStatsChanged = QtCore.pyqtSignal()
+    sigInputAdded = QtCore.pyqtSignal(str)
+
+    def __init__(self, engine, name='import_data', depth=1):
+        super().__init__()
+        self.engine = engine
+        self.name = name            # input of frames without 'input' metadata
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()    # input name -> deque
+        self.values = {}            # input name -> last frame submitted
+        self.wakeup_posted = False
+        self.received = 0
+        self.dropped = 0
+        self.latency = None         # capture to display of the last frame [s]
+        self.mean_latency = None    # exponential moving average [s]
+        self.sigPending.connect(self.dispatch, QtCore.Qt.QueuedConnection)
+        self.engine.sigJobFinished.connect(self.job_finished)
+
+    def set_depth(self, depth):
+        with self.lock:
+            self.depth = depth
+            for name, frames in self.pending.items():
+                self.pending[name] = collections.deque(frames, maxlen=depth)
+
+    def put(self, frame):
+        name = frame.metadata.get('input', self.name)
+        with self.lock:
+            self.received += 1
+            frames = self.pending.get(name)
+            if frames is None:
+                frames = collections.deque(maxlen=self.depth)
+                self.pending[name] = frames
+            if len(frames) == frames.maxlen:
+                self.dropped += 1
+            frames.append(frame)
+            if self.wakeup_posted:
+                return
+            self.wakeup_posted = True
+        self.sigPending.emit()
+
+    def dispatch(self):
+        with self.lock:
+            self.wakeup_posted = False
+        while not self.engine.is_busy():
+            with self.lock:
+                frames = {name: frames.popleft()
+                          for name, frames in self.pending.items()
+                          if len(frames) != 0}
+            if len(frames) == 0:
+                return
+            for name in frames:
+                if name not in self.values:
+                    self.sigInputAdded.emit(name)
+            self.values.update(frames)
+            self.engine.submit(**self.values)
+
+    def job_finished(self, job, shown):
+        # latency of the newest frame of the job
+        timestamps = [getattr(frame, 'timestamp', None)
+                      for frame in job.inputs.values()]
+        timestamps = [t for t in timestamps if t is not None]
+        if shown and len(timestamps) != 0:
+            self.latency = time.time() - max(timestamps)
+            if self.mean_latency is None:
+                self.mean_latency = self.latency
+            else:
+                self.mean_latency += 0.1 * (self.latency - self.mean_latency)
+            self.sigStatsChanged.emit()
+        self.dispatch()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(received=self.received,
+                        dropped=self.dropped + self.engine.dropped,
+                        pending=sum(len(f) for f in self.pending.values()),
+                        latency=self.latency,
+                        mean_latency=self.mean_latency)
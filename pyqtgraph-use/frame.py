@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Frame record passed between importers and flowchart nodes
+"""
+
+import time
+import itertools
+
+
+class Frame(object):
+    """
+    This is Frame
+    画像とその属性をまとめた不変レコード
+
+    nodes never modify a frame, they return a new one with replace(),
+    so a frame can be shared between branches and threads.
+    the image array itself is shared as well and must not be written to.
+    """
+    __slots__ = ('image', 'color', 'timestamp', 'frame_id', 'metadata')
+
+    _ids = itertools.count()
+
+    def __init__(self, image, color='BGR', timestamp=None, frame_id=None,
+                 metadata=None):
+        set_ = object.__setattr__
+        set_(self, 'image', image)
+        set_(self, 'color', color)          # one of CvtColorNode.color_names
+        set_(self, 'timestamp', timestamp)  # capture time [s] (time.time())
+        set_(self, 'frame_id', frame_id)
+        set_(self, 'metadata', {} if metadata is None else metadata)
+
+    @classmethod
+    def capture(cls, image, color='BGR', **metadata):
+        """
+        new frame stamped with the current time and the next frame id
+        """
+        return cls(image, color, time.time(), next(cls._ids), metadata)
+
+    def replace(self, **kwargs):
+        """
+        copy of this frame with some fields replaced
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(kwargs)
+        return Frame(**values)
+
+    def __reduce__(self):
+        return (Frame, (self.image, self.color, self.timestamp,
+                        self.frame_id, self.metadata))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Frame is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Frame is immutable')
+
+    def __repr__(self):
+        shape = None if self.image is None else self.image.shape
+        return 'Frame(shape={0}, color={1}, timestamp={2}, frame_id={3})'.format(
+            shape, self.color, self.timestamp, self.frame_id)
@@ -10,10 +10,10 @@ import socket
 import select
 import struct
 import threading
+import traceback
 
 import numpy as np
 import cv2
-from tqdm import tqdm
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 import deps.pyqtgraph.pyqtgraph as pg
@@ -22,6 +22,9 @@ import deps.pyqtgraph.pyqtgraph.flowchart as pgfc
 
 import node_calc
 import node_view
+import frame
+import engine
+import video_source
 import my_scapy
 import scapy
 
@@ -108,7 +111,7 @@ class PacketImporter(AbstractImporter):
         """
         This is Packet Capturer (inner class)
         """
-        sigDataEmited = QtCore.pyqtSignal(dict)
+        sigDataEmited = QtCore.pyqtSignal(object)
         sigPlayStoped = QtCore.pyqtSignal()
 
         def __init__(self, parent=None):
@@ -143,7 +146,7 @@ class PacketImporter(AbstractImporter):
             pkt.show3()
             image = self.parser.toimage(pkt)
             if image is not None:
-                self.sigDataEmited.emit(dict(image=image))
+                self.sigDataEmited.emit(frame.Frame.capture(image))
 
 
     def __init__(self):
@@ -205,9 +208,11 @@ class SocketImporter(AbstractImporter):
         this inner class is UDP Server (inner class)
         Always monitor UDP port 50030 (my_scapy.VP_PORT)
         """
-        sigDataEmited = QtCore.pyqtSignal(dict)
+        sigDataEmited = QtCore.pyqtSignal(object)
         sigPlayStoped = QtCore.pyqtSignal() # not used
         read_waiters = {}
+        # datagrams received per wakeup at most
+        batch_size = 64
 
         def __init__(self, parent=None):
             super().__init__(parent)
@@ -218,6 +223,11 @@ class SocketImporter(AbstractImporter):
             host = self.udp_sock.getsockname()[0]
             port = my_scapy.VP_PORT
             self.udp_sock.bind((host, port))
+            self.udp_sock.setblocking(False)
+            # receive buffer, reused for every datagram
+            self.recv_buf = bytearray(65536)
+            # ssrc -> flowchart input name
+            self.input_names = {}
             # wait data
             self.read_waiters[self.udp_sock.fileno()] = (self.recv_handler, ())
 
@@ -236,14 +246,44 @@ class SocketImporter(AbstractImporter):
                     handler, args = self.read_waiters.pop(r_fileno)
                     handler(*args)
 
+        def get_input_name(self, ssrc):
+            # the primary stream of the parser feeds import_data, every other
+            # one its own flowchart input. a restarted sender has a new SSRC,
+            # its stream takes import_data over once the old one went idle
+            for old in [s for s in self.input_names
+                        if s not in self.parser.streams]:
+                # evicted by the parser
+                del self.input_names[old]
+            if ssrc == self.parser.primary:
+                name = 'import_data'
+            else:
+                name = 'stream_{0:08x}'.format(ssrc)
+            self.input_names[ssrc] = name
+            return name
+
         def recv_handler(self):
-            # receive data
-            buf = self.udp_sock.recv(20000)
-            pkt = my_scapy.RTP(buf)
-            image = self.parser.toimage(pkt)
-            # emit data
-            if image is not None:
-                self.sigDataEmited.emit(dict(image=image))
+            # receive all queued datagrams (up to batch_size) into the
+            # pooled buffer, the RTP header is parsed without scapy
+            for _ in range(self.batch_size):
+                try:
+                    size = self.udp_sock.recv_into(self.recv_buf)
+                except (BlockingIOError, InterruptedError):
+                    break
+                try:
+                    rtp = my_scapy.parse_rtp(memoryview(self.recv_buf)[:size])
+                    if rtp is None:
+                        continue
+                    seq, timestamp, marker, ssrc, payload = rtp
+                    image = self.parser.add_fragment(
+                        seq, timestamp, marker, payload, ssrc)
+                except Exception:
+                    # one bad datagram must not stop the receive thread
+                    traceback.print_exc()
+                    continue
+                # emit data
+                if image is not None:
+                    self.sigDataEmited.emit(frame.Frame.capture(
+                        image, ssrc=ssrc, input=self.get_input_name(ssrc)))
             # wait next data
             self.read_waiters[self.udp_sock.fileno()] = (
                 self.recv_handler,  # handler
@@ -340,7 +380,7 @@ class FileImporter(AbstractImporter):
     """
     This is File Importer
     """
-    sigDataEmited = QtCore.pyqtSignal(dict)
+    sigDataEmited = QtCore.pyqtSignal(object)
     sigPlayStoped = QtCore.pyqtSignal()
 
     def __init__(self):
@@ -348,7 +388,6 @@ class FileImporter(AbstractImporter):
         self.filename = None
         self.dirname = os.getcwd()
         self.video = None
-        self.video_itr = None
         self.image = None
 
         self.setEnabled(back=True, refresh=True, play=True, step=True)
@@ -381,6 +420,7 @@ class FileImporter(AbstractImporter):
         self.spin_box.setEnabled(False)
         self.h_slider.valueChanged.connect(self.spin_box.setValue)
         self.spin_box.valueChanged.connect(self.h_slider.setValue)
+        self.h_slider.sliderReleased.connect(self._seek)
         lay2.addWidget(self.h_slider)
         lay2.addWidget(self.spin_box)
 
@@ -406,29 +446,29 @@ class FileImporter(AbstractImporter):
             self.dirname = os.path.dirname(self.filename)
             self.line_edit_file.setText(self.filename)
 
+            if self.video is not None:
+                self.video.close()
             _, ext = os.path.splitext(self.filename)
             if    ext in {"", ".pcap", ".pcapng"}:
                 # Load pcap/pcapng
-                self.video = my_scapy.load_pcap_file(self.filename)
+                self.video = video_source.ListSource(
+                    my_scapy.load_pcap_file(self.filename))
             elif  ext in {".mp4"}:
-                cap = cv2.VideoCapture(self.filename)
-                self.video = []
-                frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-                pbar = tqdm(total=frame_count, desc="Loading Video")
-                while cap.isOpened():
-                    ret, image = cap.read()
-                    pbar.update(1)
-                    if ret:
-                        self.video.append(image)
-                    else:
-                        break
-                pbar.close()
-                cap.release()
+                # frames are decoded while playing
+                try:
+                    self.video = video_source.VideoFileSource(self.filename)
+                except IOError as e:
+                    print(e)
+                    self.video = None
+                    return
             else:
                 self.video = None
                 return
+            self.spin_box.setValue(0)
             self.h_slider.setMaximum(len(self.video))
             self.spin_box.setMaximum(len(self.video))
+            self.h_slider.setEnabled(True)
+            self.spin_box.setEnabled(True)
 
     def get_name(self):
         return 'File'
@@ -454,16 +494,12 @@ class FileImporter(AbstractImporter):
                 self.spin_box.setValue(0)
             self.h_slider.setEnabled(False)
             self.spin_box.setEnabled(False)
-            idx = self.spin_box.value()
-            self.video_itr = iter(self.video[idx:])
             self.timer.start()
         super().play()
 
     def step(self):
         if self.video is None:
             return
-        idx = self.spin_box.value()
-        self.video_itr = iter(self.video[idx:])
         self._update()
     
     def back(self):
@@ -471,24 +507,33 @@ class FileImporter(AbstractImporter):
     
     def refresh(self):
         if self.image is not None:
-            self.sigDataEmited.emit(dict(image=self.image))
+            self.sigDataEmited.emit(frame.Frame.capture(self.image))
+
+    def _seek(self):
+        # show the frame under the slider without advancing
+        if self.video is None or self.h_slider.value() >= len(self.video):
+            return
+        self.image = self.video.get(self.h_slider.value())
+        self.refresh()
 
     def _update(self):
-        try:
-            self.image = next(self.video_itr)
-            idx = self.spin_box.value()
-            self.spin_box.setValue(idx+1)
-            if self.image is not None:
-                self.sigDataEmited.emit(dict(image=self.image))
-        except StopIteration:
+        idx = self.spin_box.value()
+        image = None
+        if idx < len(self.video):
+            image = self.video.get(idx)
+        if image is None:
             self.sigPlayStoped.emit()
+            return
+        self.image = image
+        self.spin_box.setValue(idx+1)
+        self.sigDataEmited.emit(frame.Frame.capture(self.image))
 
 
 class WebCamImporter(AbstractImporter):
     """
     This is USB WebCam Importer
     """
-    sigDataEmited = QtCore.pyqtSignal(dict)
+    sigDataEmited = QtCore.pyqtSignal(object)
 
     def __init__(self):
         super().__init__()
@@ -531,7 +576,7 @@ class WebCamImporter(AbstractImporter):
     def _update(self):
         success, image = self.capture.read()
         if success:
-            self.sigDataEmited.emit(dict(image=image))
+            self.sigDataEmited.emit(frame.Frame.capture(image))
 
 
 class StreamController(QtWidgets.QTabWidget):
@@ -542,6 +587,15 @@ class StreamController(QtWidgets.QTabWidget):
         super().__init__(parent)
 
         self.flowchart = flowchart
+        # the flowchart is evaluated on worker threads
+        self.engine = engine.FlowchartEngine(flowchart)
+        # importers hand frames over from their own threads, only the
+        # latest pending frame is kept while the flowchart is busy
+        self.dispatcher = engine.FrameDispatcher(self.engine)
+        self.dispatcher.sigStatsChanged.connect(self._update_stats)
+        self.dispatcher.sigInputAdded.connect(self._add_input)
+        self.label_stats = QtWidgets.QLabel(self)
+        self.setCornerWidget(self.label_stats)
 
         self.importers = []
         self.importers.append(WebCamImporter())
@@ -552,7 +606,8 @@ class StreamController(QtWidgets.QTabWidget):
 
         self.currentChanged.connect(self._change_importer)
         [ self.addTab(i, i.get_name()) for i in self.importers ]
-        [ i.get_data_signal().connect(self.set_data) for i in self.importers ]
+        [ i.get_data_signal().connect(self.set_data, QtCore.Qt.DirectConnection)
+          for i in self.importers ]
         [ i.play() for i in self.importers if i.is_playing() ]
         
         self._change_importer(0)
@@ -563,11 +618,23 @@ class StreamController(QtWidgets.QTabWidget):
         # get current widget
         self.importer = self.currentWidget()
 
+    def _add_input(self, name):
+        # a new stream, e.g. another SSRC on the socket importer
+        if name not in self.flowchart.inputs():
+            self.flowchart.addInput(name)
 
+    def set_queue_depth(self, depth):
+        self.dispatcher.set_depth(depth)
 
     def set_data(self, data):
         ## Set the raw data as the input value to the flowchart
-        self.flowchart.setInput(import_data=data)
+        ## (called on the importer's thread)
+        self.dispatcher.put(data)
+
+    def _update_stats(self):
+        stats = self.dispatcher.get_stats()
+        self.label_stats.setText('dropped {0}  latency {1:.0f} ms'.format(
+            stats['dropped'], stats['mean_latency'] * 1000))
 
 
 class MainForm(QtWidgets.QMainWindow):
@@ -623,6 +690,12 @@ class MainForm(QtWidgets.QMainWindow):
         fc.connectTerminals(fc['import_data'], fc['export_data'])
 
         self.fc = fc
+        self.sc = sc
+
+    def closeEvent(self, event):
+        # wait for the worker threads of the flowchart
+        self.sc.engine.close()
+        super().closeEvent(event)
 
 
 def main():
@@ -2,7 +2,7 @@
 """
 my scapy extension
 """
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from scapy.fields import *
 from scapy.packet import *
@@ -11,6 +11,9 @@ from scapy.layers.inet import *
 from scapy.layers.rtp import *
 from scapy.utils import *
 
+import time
+import random
+
 import numpy as np
 from tqdm import tqdm
 
@@ -196,59 +199,405 @@ class VideoProtocol(RTP):
         pkt.show()
 
 
+RTP_HEADER = struct.Struct("!BBHII")
+
+
+def parse_rtp(buf):
+    """
+    fast RTP decoder without scapy
+
+    returns (sequence, timestamp, marker, ssrc, payload) or None for a
+    malformed packet. payload is a memoryview of buf, buf must stay
+    unchanged while it is used.
+    """
+    view = memoryview(buf)
+    if len(view) < RTP_HEADER.size:
+        return None
+    flags, mark_type, seq, timestamp, ssrc = RTP_HEADER.unpack_from(view)
+    if flags >> 6 != 2:
+        return None
+    start = RTP_HEADER.size + (flags & 0x0f) * 4   # CSRC list
+    end = len(view)
+    if flags & 0x10:
+        # header extension
+        if end < start + 4:
+            return None
+        start += 4 + struct.unpack_from("!H", view, start + 2)[0] * 4
+    if flags & 0x20:
+        # padding, the last byte is its length
+        end -= view[end - 1]
+    if start > end:
+        return None
+    return (seq, timestamp, mark_type >> 7, ssrc, view[start:end])
+
+
+class FrameAssembly():
+    """
+    Frame Assembly
+
+    reassembly of one frame (one SSRC and RTP timestamp).
+    the frame buffer is allocated once the header is known and every
+    payload is copied into place, so fragments may arrive out of order.
+    """
+    header = struct.Struct("III")
+    # larger frames are dropped (header + pixels, 64MiB holds 4K RGB)
+    max_size = 64 * 1024 * 1024
+    # fragments of a frame must fit in half the sequence number space
+    max_fragments = 0x8000
+
+    def __init__(self, timestamp, next_seq=None):
+        self.timestamp = timestamp
+        self.created = time.time()
+        self.next_seq = next_seq    # sequence number following the last frame
+        self.buffer = None          # np.uint8 array, header + pixels
+        self.shape = None
+        self.first_seq = None
+        self.frag_size = None
+        self.frag_count = None
+        self.marker_seq = None
+        self.pending = {}           # seq -> payload, until the header is known
+        self.received = set()       # fragment indexes copied into the buffer
+        self.nbytes = 0             # memory held by pending or buffer
+        self.failed = False
+
+    def add(self, seq, marker, payload):
+        """
+        add one fragment, returns the image when the frame is complete
+        """
+        if marker:
+            self.marker_seq = seq
+        if self.buffer is None:
+            data = bytes(payload)
+            self.nbytes += len(data) - len(self.pending.get(seq, b""))
+            self.pending[seq] = data
+            first = self._find_first()
+            if first is None or not self._allocate(first):
+                return None
+            pending, self.pending = self.pending, {}
+            for p_seq, p_payload in pending.items():
+                if not self._place(p_seq, p_payload):
+                    return None
+        elif not self._place(seq, payload):
+            return None
+
+        if len(self.received) < self.frag_count:
+            return None
+        return self.buffer[self.header.size:].reshape(self.shape)
+
+    def end_seq(self):
+        return (self.first_seq + self.frag_count) & 0xffff
+
+    def _find_first(self):
+        # the fragment right after the previous frame, or else the one
+        # furthest before the marker whose header accounts for the marker
+        if self.next_seq in self.pending:
+            return self.next_seq
+        if self.marker_seq is None:
+            return None
+        first = max(self.pending, key=lambda s: (self.marker_seq - s) & 0xffff)
+        count = self._count_fragments(self.pending[first])
+        if count != ((self.marker_seq - first) & 0xffff) + 1:
+            return None
+        return first
+
+    def _count_fragments(self, payload):
+        if len(payload) < self.header.size:
+            return None
+        row, col, dim = self.header.unpack_from(payload)
+        size = self.header.size + row * col * max(dim, 1)
+        if len(payload) >= size:
+            return 1
+        return -(-size // len(payload))
+
+    def _allocate(self, first):
+        payload = self.pending[first]
+        if len(payload) < self.header.size:
+            self._fail()
+            return False
+        row, col, dim = self.header.unpack_from(payload)
+        if   dim == 0:
+            # grayscale
+            shape = (row, col)
+        elif dim == 3:
+            shape = (row, col, dim)
+        else:
+            # unexpected image format
+            self._fail()
+            return False
+        # the header comes from the network, a corrupted or forged one must
+        # not allocate more than a frame can be
+        size = self.header.size + row * col * max(dim, 1)
+        frag_size = min(len(payload), size)
+        frag_count = -(-size // frag_size)
+        if size > self.max_size or frag_count > self.max_fragments:
+            self._fail()
+            return False
+        if self.marker_seq is not None and \
+                frag_count != ((self.marker_seq - first) & 0xffff) + 1:
+            self._fail()
+            return False
+        self.buffer = np.empty(size, dtype=np.uint8)
+        self.nbytes = size
+        self.shape = shape
+        self.first_seq = first
+        self.frag_size = frag_size
+        self.frag_count = frag_count
+        return True
+
+    def _place(self, seq, payload):
+        index = (seq - self.first_seq) & 0xffff
+        offset = index * self.frag_size
+        end = min(offset + self.frag_size, len(self.buffer))
+        if index >= self.frag_count or len(payload) != end - offset:
+            # not part of this frame or corrupted
+            self._fail()
+            return False
+        memoryview(self.buffer)[offset:end] = payload
+        self.received.add(index)
+        return True
+
+    def _fail(self):
+        # the frame can not be completed, its memory is released at once
+        self.failed = True
+        self.buffer = None
+        self.pending = {}
+        self.nbytes = 0
+
+
+class VideoStream():
+    """
+    Video Stream
+
+    frames being reassembled for one RTP SSRC
+    """
+    def __init__(self, ssrc):
+        self.ssrc = ssrc
+        self.next_seq = None        # sequence number following the last frame
+        self.done_timestamp = None  # timestamp of the last frame returned
+        self.assemblies = OrderedDict()  # timestamp -> FrameAssembly
+        self.last_time = time.time()
+
+    def is_old(self, timestamp):
+        # timestamp of the last frame returned or before it (with wraparound)
+        if self.done_timestamp is None:
+            return False
+        diff = (timestamp - self.done_timestamp) & 0xffffffff
+        return diff == 0 or diff >= 0x80000000
+
+
 class VideoProtocolParser():
     """
     Video Protocol Parser
 
+    a frame is sent as fragments which share the RTP timestamp and carry
+    consecutive sequence numbers. the first fragment starts with the
+    row/col/dim header, the last one has the marker bit set, and all but
+    the last one have the same payload size.
+    fragments are demultiplexed by SSRC, so several senders may share a port.
+    for each stream at most max_frames frames are reassembled at a time,
+    and all streams together hold at most max_bytes.
+    an incomplete frame is dropped when a newer frame of its stream is
+    complete, when it is older than timeout seconds, or to make room.
+    the primary stream is the one a single-camera receiver shows. it is
+    handed to the next stream completing a frame when it has been idle for
+    timeout seconds or evicted, e.g. a restarted sender has a new SSRC.
     """
-    def __init__(self):
-        self.buffer = b""
-        self.split_size = 4096
+    def __init__(self, timeout=1.0, max_frames=4, max_streams=16,
+                 split_size=4096, max_bytes=256 * 1024 * 1024):
+        # sender side, one stream per parser
+        self.split_size = split_size    # RTP payload size (VP_SPLIT_SIZE)
+        self.payload_type = 0
+        self.ssrc = random.getrandbits(32)
+        self.sequence = 0
+        self.timestamp = None
+        self.image_header = bytearray(FrameAssembly.header.size)
+        self.rtp_headers = bytearray()
+        self.timeout = timeout
+        self.max_frames = max_frames
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self.nbytes = 0         # memory held by the frames being reassembled
+        self.lost = 0           # frames dropped because of missing fragments
+        self.streams = OrderedDict()    # ssrc -> VideoStream, least recent first
+        self.primary = None     # ssrc of the primary stream
+        self.evict_time = time.time()
 
     def toimage(self, pkt):
         assert isinstance(pkt, Packet), "pkt is not Packet"
         if    VideoProtocol in pkt:
             pkt = pkt[VideoProtocol]
         elif RTP in pkt:
-            pkt = VideoProtocol(raw(pkt[RTP]))
+            # same fields, no need to parse it again as VideoProtocol
+            pkt = pkt[RTP]
         else:
             assert False, "pkt has not VideoProtocol"
+        return self.add_fragment(
+            pkt.sequence, pkt.timestamp, pkt.marker, pkt.load, pkt.sourcesync)
 
-        self.buffer += pkt.load
-        if pkt.marker == 1:
-            row, col, dim = struct.unpack("III", self.buffer[:12])
-            image = np.frombuffer(self.buffer[12:], dtype=np.uint8)
-            if row * col != len(image):
-                return None
-            if   dim == 0:
-                # grayscale
-                image = image.reshape((row,col))
-            elif dim == 3:
-                image = image.reshape((row, col, dim))
-            else:
-                assert False, "unexpected image format"
-            self.buffer = b""
-            return image
-        else:
+    def frombytes(self, buf):
+        """
+        same as toimage() for a raw RTP packet, without scapy
+        """
+        rtp = parse_rtp(buf)
+        if rtp is None:
             return None
+        seq, timestamp, marker, ssrc, payload = rtp
+        return self.add_fragment(seq, timestamp, marker, payload, ssrc)
 
-    def fromimage(self, image):
+    def add_fragment(self, seq, timestamp, marker, payload, ssrc=0):
+        """
+        add one fragment, returns the image when its frame is complete
+        """
+        now = time.time()
+        if now - self.evict_time > self.timeout / 4:
+            self.evict(now)
+        stream = self.streams.pop(ssrc, None)
+        if stream is None:
+            if len(self.streams) >= self.max_streams:
+                self._remove_stream(next(iter(self.streams)))
+            stream = VideoStream(ssrc)
+        self.streams[ssrc] = stream
+        stream.last_time = now
+        if stream.is_old(timestamp):
+            # late fragment of a frame already returned or dropped
+            return None
+
+        assembly = stream.assemblies.get(timestamp)
+        if assembly is None:
+            if len(stream.assemblies) >= self.max_frames:
+                self._drop(stream, 1)
+            assembly = FrameAssembly(timestamp, stream.next_seq)
+            stream.assemblies[timestamp] = assembly
+        elif assembly.failed:
+            return None
+
+        nbytes = assembly.nbytes
+        image = assembly.add(seq, marker, payload)
+        self.nbytes += assembly.nbytes - nbytes
+        if assembly.failed:
+            self.lost += 1
+            return None
+        if image is None:
+            if self.nbytes > self.max_bytes:
+                self._trim()
+            return None
+        # older frames can not be shown any more
+        self._remove(stream, assembly, lost=False)
+        stream.done_timestamp = timestamp
+        stream.next_seq = assembly.end_seq()
+        older = [a for a in stream.assemblies.values()
+                 if stream.is_old(a.timestamp)]
+        for a in older:
+            self._remove(stream, a)
+        if self.primary is None or \
+                now - self.streams[self.primary].last_time > self.timeout:
+            self.primary = ssrc
+        return image
+
+    def evict(self, now=None):
+        """
+        drop frames older than timeout, and streams idle for 10 * timeout
+        """
+        now = time.time() if now is None else now
+        self.evict_time = now
+        for ssrc, stream in list(self.streams.items()):
+            for a in list(stream.assemblies.values()):
+                if now - a.created > self.timeout:
+                    self._remove(stream, a)
+            if now - stream.last_time > self.timeout * 10:
+                self._remove_stream(ssrc)
+
+    def _remove(self, stream, assembly, lost=True):
+        del stream.assemblies[assembly.timestamp]
+        self.nbytes -= assembly.nbytes
+        if lost and not assembly.failed:
+            self.lost += 1
+
+    def _remove_stream(self, ssrc):
+        stream = self.streams.pop(ssrc)
+        self._drop(stream, len(stream.assemblies))
+        if ssrc == self.primary:
+            self.primary = None
+
+    def _drop(self, stream, count):
+        # drop the count oldest frames of stream
+        for a in list(stream.assemblies.values())[:count]:
+            self._remove(stream, a)
+
+    def _trim(self):
+        # drop the oldest frames of all streams until they fit in max_bytes
+        while self.nbytes > self.max_bytes:
+            stream = min((s for s in self.streams.values() if s.assemblies),
+                         key=lambda s: next(iter(s.assemblies.values())).created)
+            self._drop(stream, 1)
+
+    def iter_fragments(self, image):
+        """
+        fragments of image as lists of buffers (RTP header, payload, ...)
+        for socket.sendmsg(), the image itself is not copied.
+        the RTP headers are written into a buffer of the parser, so the
+        buffers are valid until the next call.
+        """
         assert isinstance( image, np.ndarray ) , "image is not ndarray"
+        assert image.dtype == np.uint8, "image is not uint8"
+        assert self.split_size > FrameAssembly.header.size, "split_size is too small"
+        image = np.ascontiguousarray(image)
         row = image.shape[0]
         col = image.shape[1]
         dim = image.shape[2] if len(image.shape)==3 else 0
-        buf  = struct.pack("III", row, col, dim)
-        buf += image.tostring()
-        buf_size = len(buf)
-        pkt_list = []
-        tmp_sidx = 0
-        tmp_eidx = self.split_size
-        while tmp_eidx < buf_size:
-            pkt_list.append(VideoProtocol()/buf[tmp_sidx:tmp_eidx])
-            tmp_sidx += self.split_size
-            tmp_eidx += self.split_size
-        pkt_list.append(VideoProtocol(marker=1)/buf[tmp_sidx:])
-        return pkt_list
+        FrameAssembly.header.pack_into(self.image_header, 0, row, col, dim)
+        data = memoryview(image).cast('B')
+        size = len(self.image_header) + len(data)
+        count = -(-size // self.split_size)
+        if len(self.rtp_headers) < count * RTP_HEADER.size:
+            self.rtp_headers = bytearray(count * RTP_HEADER.size)
+        headers = memoryview(self.rtp_headers)
+        # all fragments of a frame share one timestamp (90kHz clock)
+        timestamp = int(time.time() * 90000) & 0xffffffff
+        if timestamp == self.timestamp:
+            timestamp = (timestamp + 1) & 0xffffffff
+        self.timestamp = timestamp
+
+        start = 0
+        for i in range(count):
+            offset = i * RTP_HEADER.size
+            marker = 0x80 if i == count - 1 else 0
+            RTP_HEADER.pack_into(self.rtp_headers, offset, 0x80,
+                marker | self.payload_type, self.sequence, timestamp,
+                self.ssrc)
+            self.sequence = (self.sequence + 1) & 0xffff
+            header = headers[offset:offset + RTP_HEADER.size]
+            if i == 0:
+                end = self.split_size - len(self.image_header)
+                yield [header, self.image_header, data[:end]]
+            else:
+                end = start + self.split_size
+                yield [header, data[start:end]]
+            start = end
+
+    def sendto(self, sock, addr, image):
+        """
+        send image to addr, returns the number of packets
+        """
+        count = 0
+        for buffers in self.iter_fragments(image):
+            send_fragment(sock, addr, buffers)
+            count += 1
+        return count
+
+    def fromimage(self, image):
+        return [VideoProtocol(b"".join(buffers))
+                for buffers in self.iter_fragments(image)]
+
+
+def send_fragment(sock, addr, buffers):
+    """
+    send one datagram gathered from buffers
+    """
+    if hasattr(sock, "sendmsg"):
+        return sock.sendmsg(buffers, [], 0, addr)
+    # no scatter/gather (Windows)
+    return sock.sendto(b"".join(buffers), addr)
 
 
 def ip_defragment(plist):
@@ -359,5 +708,7 @@ def load_pcap_file(filename, display = True):
 
 MP_PORT = 50000
 VP_PORT = 50030
+# RTP payload fitting a 1500 byte Ethernet MTU (IP 20, UDP 8, RTP 12)
+VP_SPLIT_SIZE = 1460
 bind_layers(TCP, MessageProtocol, dport=MP_PORT)
 bind_layers(UDP, VideoProtocol,   dport=VP_PORT)
\ No newline at end of file
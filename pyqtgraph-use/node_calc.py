@@ -1,6 +1,7 @@
-import copy
 import threading
+import collections
 
+import numpy as np
 import cv2
 
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -8,13 +9,21 @@ import deps.pyqtgraph.pyqtgraph as pg
 import deps.pyqtgraph.pyqtgraph.flowchart as pgfc
 import deps.pyqtgraph.pyqtgraph.flowchart.library.common as pgfclc
 
+import engine
 
-class AbstractCalcNode(pgfclc.CtrlNode):
+
+class AbstractCalcNode(engine.EngineNode, pgfclc.CtrlNode):
     """
     Abstract ImageProcess Node
+
+    data_in / data_out are frame.Frame records.
+    the controls are read into self.params (plain values) on the GUI thread
+    whenever they change, process() reads only self.params and never
+    touches Qt widgets, so it may run on any thread.
     """
     nodeName = None
     uiTemplate = None
+    Params = None
     def __init__(self, name):
         ## Define the input / output terminals available on this node
         terminals = {
@@ -23,13 +32,34 @@ class AbstractCalcNode(pgfclc.CtrlNode):
         }                              # other more advanced options are available
                                        # as well..
         pgfclc.CtrlNode.__init__(self, name, terminals=terminals)
+        self.params = self.read_params()
+
+    def read_params(self):
+        raise NotImplementedError
+
+    def changed(self):
+        # snapshot before update() re-processes with the new values
+        self.params = self.read_params()
+        pgfclc.CtrlNode.changed(self)
+
+    def restoreState(self, state):
+        pgfclc.CtrlNode.restoreState(self, state)
+        self.params = self.read_params()
+
+    def process(self, data_in, display=True):
+        if data_in is None:
+            return {'data_out': None}
+        return {'data_out': self.process_frame(data_in, self.params)}
+
+    def process_frame(self, data_in, params):
+        raise NotImplementedError
 
     @staticmethod
     def is_gray(data_in):
-        if   len(data_in['image'].shape)==2:
+        if   len(data_in.image.shape)==2:
             return True
         else:
-            assert data_in['image'].shape[2] == 3
+            assert data_in.image.shape[2] == 3
             return False
 
 
@@ -39,16 +69,14 @@ class CannyNode(AbstractCalcNode):
         ('min', 'spin', {'value': 100, 'step': 1, 'bounds': [0, None], 'int':True }),
         ('max', 'spin', {'value': 200, 'step': 1, 'bounds': [0, None], 'int':True }),
     ]
-    def process(self, data_in, display=True):
-        # should shallow copy soon because "data_in" will change maybe
-        data_in  = copy.copy(data_in)
-        data_out = data_in
+    Params = collections.namedtuple('CannyParams', ['min', 'max'])
 
-        min = self.ctrls['min'].value()
-        max = self.ctrls['max'].value()
+    def read_params(self):
+        return self.Params(self.ctrls['min'].value(), self.ctrls['max'].value())
 
-        data_out['image'] = cv2.Canny(data_in['image'], min, max)
-        return {'data_out': data_out}
+    def process_frame(self, data_in, params):
+        image = cv2.Canny(data_in.image, params.min, params.max)
+        return data_in.replace(image=image, color='GRAY')
 
 
 class CvtColorNode(AbstractCalcNode):
@@ -60,34 +88,44 @@ class CvtColorNode(AbstractCalcNode):
          [cv2.COLOR_HLS2BGR, cv2.COLOR_HLS2RGB, None, None, None],
          [cv2.COLOR_GRAY2BGR, cv2.COLOR_GRAY2RGB, None, None, None]]
 
+    # AUTO takes the color space recorded in the frame, any other type_in
+    # overrides it
+    in_names = ['AUTO'] + color_names
+
     nodeName = "CvtColor"
     uiTemplate = [
-        ('type_in',  'combo', {'value': 'BGR', 'values': color_names}),
+        ('type_in',  'combo', {'value': 'AUTO', 'values': in_names}),
         ('type_out', 'combo', {'value': 'RGB', 'values': color_names}),
     ]
-    
-    def process(self, data_in, display=True):
-        # should shallow copy soon because "data_in" will change maybe
-        data_in  = copy.copy(data_in)
-        data_out = data_in
-
-        idx_in  = self.ctrls['type_in' ].currentIndex()
-        idx_out = self.ctrls['type_out'].currentIndex()
-
+    Params = collections.namedtuple('CvtColorParams', ['idx_in', 'idx_out'])
+
+    def read_params(self):
+        # idx_in is None for AUTO
+        idx_in = self.ctrls['type_in'].currentIndex() - 1
+        return self.Params(None if idx_in < 0 else idx_in,
+                           self.ctrls['type_out'].currentIndex())
+
+    def process_frame(self, data_in, params):
+        if params.idx_in is not None:
+            idx_in = params.idx_in
+        elif data_in.color in self.color_names:
+            idx_in = self.color_names.index(data_in.color)
+        else:
+            idx_in = self.color_names.index('BGR')
         if self.is_gray(data_in):
             idx_in = self.color_names.index('GRAY')
         else:
             if idx_in == self.color_names.index('GRAY'):
                 idx_in = self.color_names.index('BGR')
-        self.ctrls['type_in'].setCurrentIndex(idx_in)
 
-        cv2_cvt_code = self.cv2_cvt_codes[idx_in][idx_out]
+        cv2_cvt_code = self.cv2_cvt_codes[idx_in][params.idx_out]
 
         if cv2_cvt_code is not None:
-            data_out['image'] = cv2.cvtColor(data_in['image'], cv2_cvt_code)
+            image = cv2.cvtColor(data_in.image, cv2_cvt_code)
+            return data_in.replace(image=image,
+                                   color=self.color_names[params.idx_out])
         else:
-            data_out['image'] = data_in['image']
-        return {'data_out':data_out}
+            return data_in.replace(color=self.color_names[idx_in])
 
 
 class ThreshNode(AbstractCalcNode):
@@ -104,26 +142,29 @@ class ThreshNode(AbstractCalcNode):
         ('max_value', 'spin', {'value': 200, 'step': 1, 'bounds': [0, None], 'int':True }),
         ('otsu', 'check', {'checkd': False}),
     ]
-    def process(self, data_in, display=True):
-        # should shallow copy soon because "data_in" will change maybe
-        data_in = copy.copy(data_in)
-        data_out = data_in
+    Params = collections.namedtuple(
+        'ThreshParams', ['cv2_thresh_type', 'threshold', 'max_value', 'otsu'])
 
+    def read_params(self):
         thresh_idx = self.ctrls['type' ].currentIndex()
-        threshold = self.ctrls['threshold'].value()
-        max_value = self.ctrls['max_value'].value()
-        has_otsu = self.ctrls['otsu'].isChecked()
-        cv2_thresh_type = self.cv2_thresh_types[thresh_idx]
+        return self.Params(self.cv2_thresh_types[thresh_idx],
+                           self.ctrls['threshold'].value(),
+                           self.ctrls['max_value'].value(),
+                           self.ctrls['otsu'].isChecked())
 
-        if has_otsu:
+    def process_frame(self, data_in, params):
+        threshold = params.threshold
+        cv2_thresh_type = params.cv2_thresh_type
+
+        if params.otsu:
             if self.is_gray(data_in):
                 threshold = 0
                 cv2_thresh_type = cv2_thresh_type + cv2.THRESH_OTSU
             else:
-                return {'data_out':data_out}
-        
-        _, data_out['image'] = cv2.threshold(data_in['image'], threshold, max_value, cv2_thresh_type)
-        return {'data_out':data_out}
+                return data_in
+
+        _, image = cv2.threshold(data_in.image, threshold, params.max_value, cv2_thresh_type)
+        return data_in.replace(image=image)
 
 
 class AdaptThreshNode(AbstractCalcNode):
@@ -145,24 +186,25 @@ class AdaptThreshNode(AbstractCalcNode):
         ('block_size', 'spin', {'value': 11, 'step': 1, 'bounds': [0, None], 'int':True }),
         ('parameter', 'spin', {'value': 2, 'step': 1, 'bounds': [None, None] }),
     ]
-    def process(self, data_in, display=True):
-        # should shallow copy soon because "data_in" will change maybe
-        data_in = copy.copy(data_in)
-        data_out = data_in
-
-        if not self.is_gray(data_in):
-            return {'data_out':data_out}
+    Params = collections.namedtuple(
+        'AdaptThreshParams', ['mv', 'cv2_am', 'cv2_tt', 'bs', 'p1'])
 
+    def read_params(self):
         thresh_idx = self.ctrls['type' ].currentIndex()
         method_idx = self.ctrls['method'].currentIndex()
-        mv = self.ctrls['max_value'].value()
-        bs = self.ctrls['block_size'].value()
-        p1 = self.ctrls['parameter'].value()
-        cv2_tt = self.cv2_thresh_types[thresh_idx]
-        cv2_am = self.cv2_adapt_methods[method_idx]
-        data_out['image'] = cv2.adaptiveThreshold(data_in['image'], mv, cv2_am, cv2_tt, bs, p1)
+        return self.Params(self.ctrls['max_value'].value(),
+                           self.cv2_adapt_methods[method_idx],
+                           self.cv2_thresh_types[thresh_idx],
+                           self.ctrls['block_size'].value(),
+                           self.ctrls['parameter'].value())
+
+    def process_frame(self, data_in, params):
+        if not self.is_gray(data_in):
+            return data_in
 
-        return {'data_out':data_out}
+        image = cv2.adaptiveThreshold(data_in.image, params.mv, params.cv2_am,
+                                      params.cv2_tt, params.bs, params.p1)
+        return data_in.replace(image=image)
 
 
 class UnsharpMaskNode(AbstractCalcNode):
@@ -172,12 +214,18 @@ class UnsharpMaskNode(AbstractCalcNode):
         ('sigma',  'spin', {'value': 1.0, 'step': 1.0, 'bounds': [0.0, None]}),
         ('strength', 'spin', {'value': 1.0, 'dec': True, 'step': 0.5, 'minStep': 0.01, 'bounds': [0.0, None]}),
     ]
-    def process(self, data_in, display=True):
+    Params = collections.namedtuple('UnsharpMaskParams', ['sigma', 'strength'])
+
+    def read_params(self):
         # CtrlNode has created self.ctrls, which is a dict containing {ctrlName: widget}
-        sigma = self.ctrls['sigma'].value()
-        strength = self.ctrls['strength'].value()
-        data_out = data_in - (strength * pg.gaussianFilter(data_in, (sigma,sigma)))
-        return {'data_out': data_out}
+        return self.Params(self.ctrls['sigma'].value(),
+                           self.ctrls['strength'].value())
+
+    def process_frame(self, data_in, params):
+        image = data_in.image.astype(np.float32)
+        sigma = (params.sigma, params.sigma) + (0,) * (image.ndim - 2)
+        image = image - (params.strength * pg.gaussianFilter(image, sigma))
+        return data_in.replace(image=image)
 
 
 
@@ -1,9 +1,12 @@
+import numpy as np
+
 from PyQt5 import QtCore, QtGui, QtWidgets
 import deps.pyqtgraph.pyqtgraph as pg
 import deps.pyqtgraph.pyqtgraph.flowchart as pgfc
 import deps.pyqtgraph.pyqtgraph.dockarea as pgda
 import deps.pyqtgraph.pyqtgraph.flowchart.library.common as pgfclc
 import my_pyqtgraph
+import engine
 
 
 class SubWindow(QtWidgets.QDialog):
@@ -17,12 +20,14 @@ class SubWindow(QtWidgets.QDialog):
             layout.addWidget(child)
 
 
-class AbstractViewNode(pgfclc.CtrlNode):
+class AbstractViewNode(engine.EngineNode, pgfclc.CtrlNode):
     """
     Abstract View Node
     This is Node that displays image data in an View widget
+    (always processed on the GUI thread)
     """
     nodeName = 'AbstractView'
+    gui_thread = True
     uiTemplate = [
         ('view',  'button', {}),
     ]
@@ -91,10 +96,10 @@ class ImageViewNode(AbstractViewNode):
             if data_in is None:
                 self.image_view.setImage(np.zeros((1,1)))
             else:
-                image = data_in['image']
+                image = data_in.image
                 if   len(image.shape) == 2:
                     # for grayscale
-                    self.image_view.setImage(data_in['image'].transpose((1,0)))
+                    self.image_view.setImage(image.transpose((1,0)))
                 elif len(image.shape) == 3:
                     # for color
                     self.image_view.setImage(image.transpose((1,0,2)))
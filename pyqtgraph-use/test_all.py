@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-test for my_scapy
+test for my_scapy, frame, video_source and engine
 
 ref) pytestに入門してみたメモ
 https://qiita.com/hira_physics/items/1a2748e443d8282c94b2
@@ -10,12 +10,26 @@ https://qiita.com/kg1/items/4e2cae18e9bd39f014d4
 
 """
 
+import os
+import copy
+import time
+import threading
+import socket
+import tempfile
 import unittest
 import struct
 
 import numpy as np
+import cv2
 
 import my_scapy
+import frame
+import video_source
+try:
+    from PyQt5 import QtCore
+    import engine
+except ImportError:
+    engine = None
 
 class TestEnCodeDecode(unittest.TestCase):
     """
@@ -66,5 +80,491 @@ class TestVideoProtocolParser(unittest.TestCase):
                 break
         np.testing.assert_array_equal(self.image, image)
 
+    def fragments(self, image, split_size, timestamp):
+        # (seq, timestamp, marker, payload) as sent by fromimage
+        dim = image.shape[2] if len(image.shape)==3 else 0
+        buf = struct.pack("III", image.shape[0], image.shape[1], dim)
+        buf += image.tobytes()
+        chunks = [buf[i:i+split_size] for i in range(0, len(buf), split_size)]
+        return [(seq, timestamp, seq == len(chunks)-1, chunk)
+                for seq, chunk in enumerate(chunks)]
+
+    def test_out_of_order(self):
+        parser = my_scapy.VideoProtocolParser()
+        image = np.arange(4*5*3, dtype=np.uint8).reshape((4,5,3))
+        frags = self.fragments(image, 16, 100)
+        frags.reverse()
+        results = [parser.add_fragment(*f) for f in frags]
+        self.assertTrue(all(r is None for r in results[:-1]))
+        np.testing.assert_array_equal(results[-1], image)
+
+    def test_lost(self):
+        parser = my_scapy.VideoProtocolParser()
+        image = np.arange(6*7, dtype=np.uint8).reshape((6,7))
+        frags = self.fragments(image, 16, 100)
+        for f in frags[:1] + frags[2:]:
+            self.assertIsNone(parser.add_fragment(*f))
+        # the next frame drops the incomplete one
+        results = [parser.add_fragment(*f)
+                   for f in self.fragments(image, 16, 200)]
+        np.testing.assert_array_equal(results[-1], image)
+        self.assertEqual(parser.lost, 1)
+
+    def test_frombytes(self):
+        parser = my_scapy.VideoProtocolParser()
+        image = np.arange(6*7*3, dtype=np.uint8).reshape((6,7,3))
+        for seq, timestamp, marker, payload in self.fragments(image, 50, 7):
+            pkt = my_scapy.VideoProtocol(
+                sequence=seq, timestamp=timestamp, marker=marker, sourcesync=9)
+            buf = bytes(pkt/payload)
+            seq1, timestamp1, marker1, ssrc, payload1 = my_scapy.parse_rtp(buf)
+            self.assertEqual((seq1, timestamp1, marker1, ssrc),
+                             (seq, timestamp, marker, 9))
+            self.assertEqual(bytes(payload1), payload)
+            result = parser.frombytes(bytearray(buf))
+        np.testing.assert_array_equal(result, image)
+
+    def test_streams(self):
+        parser = my_scapy.VideoProtocolParser()
+        image0 = np.zeros((6,7), dtype=np.uint8)
+        image1 = np.ones((6,7), dtype=np.uint8)
+        frags0 = self.fragments(image0, 16, 100)
+        frags1 = self.fragments(image1, 16, 100)
+        results = {}
+        for f0, f1 in zip(frags0, frags1):
+            results[0] = parser.add_fragment(*f0, ssrc=10)
+            results[1] = parser.add_fragment(*f1, ssrc=11)
+        np.testing.assert_array_equal(results[0], image0)
+        np.testing.assert_array_equal(results[1], image1)
+        self.assertEqual(parser.lost, 0)
+
+    def test_timeout(self):
+        parser = my_scapy.VideoProtocolParser(timeout=60.0)
+        image = np.arange(6*7, dtype=np.uint8).reshape((6,7))
+        frags = self.fragments(image, 16, 100)
+        for f in frags[:-1]:
+            parser.add_fragment(*f)
+        parser.evict(time.time() + 1000.0)
+        self.assertEqual(parser.lost, 1)
+        self.assertEqual(len(parser.streams), 0)
+
+    def send(self, sender, receiver, image):
+        results = [receiver.frombytes(b"".join(buffers))
+                   for buffers in sender.iter_fragments(image)]
+        return results[-1]
+
+    def test_restart(self):
+        receiver = my_scapy.VideoProtocolParser(timeout=1.0)
+        image = np.arange(6*7, dtype=np.uint8).reshape((6,7))
+        sender0 = my_scapy.VideoProtocolParser(split_size=16)
+        self.send(sender0, receiver, image)
+        self.assertEqual(receiver.primary, sender0.ssrc)
+        # the sender restarts with a new SSRC, while the old stream is
+        # still active the new one is a stream of its own
+        sender1 = my_scapy.VideoProtocolParser(split_size=16)
+        sender1.ssrc = sender0.ssrc ^ 1
+        self.send(sender1, receiver, image)
+        self.assertEqual(receiver.primary, sender0.ssrc)
+        # once the old stream is idle the new one takes over
+        receiver.streams[sender0.ssrc].last_time -= 2.0
+        np.testing.assert_array_equal(
+            self.send(sender1, receiver, image), image)
+        self.assertEqual(receiver.primary, sender1.ssrc)
+        # idle streams are evicted
+        receiver.evict(time.time() + 1000.0)
+        self.assertEqual(len(receiver.streams), 0)
+        self.assertIsNone(receiver.primary)
+        self.send(sender0, receiver, image)
+        self.assertEqual(receiver.primary, sender0.ssrc)
+
+    def test_max_bytes(self):
+        parser = my_scapy.VideoProtocolParser(max_bytes=200)
+        image = np.arange(6*7, dtype=np.uint8).reshape((6,7))
+        # incomplete frames of several streams
+        for ssrc in range(8):
+            for f in self.fragments(image, 16, 100)[:-1]:
+                parser.add_fragment(*f, ssrc=ssrc)
+            self.assertLessEqual(parser.nbytes, 200)
+        self.assertGreater(parser.lost, 0)
+        results = [parser.add_fragment(*f, ssrc=9)
+                   for f in self.fragments(image, 16, 100)]
+        np.testing.assert_array_equal(results[-1], image)
+        self.assertEqual(parser.nbytes, sum(
+            a.nbytes for s in parser.streams.values()
+            for a in s.assemblies.values()))
+
+    def test_bad_header(self):
+        parser = my_scapy.VideoProtocolParser()
+        image = np.arange(6*7, dtype=np.uint8).reshape((6,7))
+        headers = [(6, 7, 5),               # unexpected image format
+                   (65536, 65536, 3),       # larger than max_size
+                   (60, 70, 0)]             # more fragments than sent
+        timestamp = 100
+        seq = 0
+        for header in headers + [None]:
+            # a good frame, so the first fragment of the next one is known
+            # by its sequence number before the marker arrives
+            frags = self.fragments(image, 16, timestamp)
+            results = [parser.add_fragment((s + seq) & 0xffff, t, m, p)
+                       for s, t, m, p in frags]
+            np.testing.assert_array_equal(results[-1], image)
+            timestamp += 1
+            seq += len(frags)
+            if header is None:
+                break
+            frags = self.fragments(image, 16, timestamp)
+            frags[0] = frags[0][:3] + (
+                struct.pack("III", *header) + frags[0][3][12:],)
+            for s, t, m, p in frags:
+                self.assertIsNone(
+                    parser.add_fragment((s + seq) & 0xffff, t, m, p))
+            timestamp += 1
+            seq += len(frags)
+        self.assertEqual(parser.lost, len(headers))
+
+    def test_sendto(self):
+        sender = my_scapy.VideoProtocolParser(split_size=100)
+        receiver = my_scapy.VideoProtocolParser()
+        image = np.arange(20*30*3, dtype=np.uint8).reshape((20,30,3))
+        rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            rsock.bind(('127.0.0.1', 0))
+            rsock.settimeout(1.0)
+            count = sender.sendto(ssock, rsock.getsockname(), image[:, ::-1])
+            self.assertEqual(count, -(-(12 + image.size) // 100))
+            for _ in range(count):
+                result = receiver.frombytes(rsock.recv(65536))
+        finally:
+            rsock.close()
+            ssock.close()
+        np.testing.assert_array_equal(result, image[:, ::-1])
+
+class TestFrame(unittest.TestCase):
+    """
+    test frame.Frame
+    """
+    def test_capture(self):
+        image = np.zeros(shape=(5,5), dtype=np.uint8)
+        frame0 = frame.Frame.capture(image, 'GRAY', source='test')
+        frame1 = frame.Frame.capture(image)
+        self.assertIs(frame0.image, image)
+        self.assertEqual(frame0.color, 'GRAY')
+        self.assertEqual(frame0.metadata, {'source': 'test'})
+        self.assertLess(frame0.frame_id, frame1.frame_id)
+        self.assertLessEqual(frame0.timestamp, frame1.timestamp)
+
+    def test_replace(self):
+        frame0 = frame.Frame.capture(np.zeros(shape=(5,5,3), dtype=np.uint8))
+        frame1 = frame0.replace(image=frame0.image[:,:,0], color='GRAY')
+        self.assertEqual(frame0.color, 'BGR')
+        self.assertEqual(frame1.color, 'GRAY')
+        self.assertEqual(frame1.image.shape, (5,5))
+        self.assertEqual(frame1.frame_id, frame0.frame_id)
+        self.assertEqual(frame1.timestamp, frame0.timestamp)
+
+    def test_immutable(self):
+        frame0 = frame.Frame.capture(None)
+        with self.assertRaises(AttributeError):
+            frame0.color = 'RGB'
+        with self.assertRaises(AttributeError):
+            frame0.other = 0
+        self.assertEqual(copy.copy(frame0).frame_id, frame0.frame_id)
+
+class TestVideoFileSource(unittest.TestCase):
+    """
+    test video_source.VideoFileSource
+    """
+    count = 20
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+        writer = cv2.VideoWriter(self.filename,
+            cv2.VideoWriter_fourcc(*'mp4v'), 10, (64,48))
+        for i in range(self.count):
+            writer.write(np.full((48,64,3), i*10, dtype=np.uint8))
+        writer.release()
+        cap = cv2.VideoCapture(self.filename)
+        self.images = []
+        while True:
+            ret, image = cap.read()
+            if not ret:
+                break
+            self.images.append(image)
+        cap.release()
+        if len(self.images) != self.count:
+            self.skipTest('mp4v encoder is not available')
+        self.video = video_source.VideoFileSource(
+            self.filename, cache_size=8, read_ahead=4)
+
+    def tearDown(self):
+        self.video.close()
+        os.remove(self.filename)
+
+    def test_sequential(self):
+        self.assertEqual(len(self.video), self.count)
+        for i in range(self.count):
+            np.testing.assert_array_equal(self.video.get(i), self.images[i])
+        self.assertIsNone(self.video.get(self.count))
+
+    def test_seek(self):
+        for i in (15, 3, 4, 19, 0, 10, 9):
+            np.testing.assert_array_equal(self.video.get(i), self.images[i])
+        self.assertLessEqual(len(self.video.cache), self.video.cache_size)
+
+    def test_read_ahead(self):
+        self.video.get(5)
+        end = time.time() + 2.0
+        while not all(i in self.video.cache for i in range(6, 10)):
+            self.assertLess(time.time(), end, 'frames were not read ahead')
+            time.sleep(0.005)
+        np.testing.assert_array_equal(self.video.get(8), self.images[8])
+
+
+class PlainTerminal(object):
+    """
+    terminal with the part of the pyqtgraph interface the engine uses
+    """
+    def __init__(self, node, name, sources=()):
+        self._node = node
+        self._name = name
+        self.sources = list(sources)
+
+    def node(self):
+        return self._node
+
+    def name(self):
+        return self._name
+
+    def inputTerminals(self):
+        return self.sources
+
+    def isMultiValue(self):
+        return False
+
+
+if engine is not None:
+    class PlainNode(engine.EngineNode):
+        """
+        node applying func to data_in, records the order of processing
+        """
+        def __init__(self, name, func=None, sources=(), gui_thread=False,
+                     log=None, delay=0.0):
+            self.name = name
+            self.func = func
+            self.gui_thread = gui_thread
+            self.log = log
+            self.delay = delay
+            self.bypassed = False
+            self.exception = None
+            self._inputs = {}
+            if len(sources) != 0:
+                self._inputs['data_in'] = PlainTerminal(self, 'data_in', sources)
+            self._outputs = {'data_out': PlainTerminal(self, 'data_out')}
+
+        def inputs(self):
+            return self._inputs
+
+        def outputs(self):
+            return self._outputs
+
+        def isBypassed(self):
+            return self.bypassed
+
+        def processBypassed(self, args):
+            return {'data_out': args.get('data_in')}
+
+        def process(self, data_in, display=True):
+            time.sleep(self.delay)
+            if self.log is not None:
+                self.log.append((self.name, data_in, display,
+                                 threading.current_thread()))
+            if self.gui_thread:
+                return None
+            if isinstance(data_in, frame.Frame):
+                return {'data_out': data_in.replace(
+                    image=self.func(data_in.image))}
+            return {'data_out': self.func(data_in)}
+
+        def setException(self, exc):
+            self.exception = exc
+
+        def clearException(self):
+            self.exception = None
+
+
+class PlainSignal(object):
+    def connect(self, slot):
+        pass
+
+
+class PlainFlowchart(object):
+    """
+    import_data -> a -> c -> view_c, import_data -> b -> view_b,
+    b -> export_data
+    """
+    def __init__(self, delay=0.0):
+        self.log = []
+        self.inputNode = PlainNode('input')
+        self.inputNode._outputs = {
+            'import_data': PlainTerminal(self.inputNode, 'import_data')}
+        source = self.inputNode.outputs()['import_data']
+        self.a = PlainNode('a', lambda x: x + 1, [source], log=self.log,
+                           delay=delay)
+        self.b = PlainNode('b', lambda x: x * 10, [source], log=self.log)
+        self.c = PlainNode('c', lambda x: x - 1,
+                           [self.a.outputs()['data_out']], log=self.log)
+        self.view_c = PlainNode('view_c', None, [self.c.outputs()['data_out']],
+                                gui_thread=True, log=self.log)
+        self.view_b = PlainNode('view_b', None, [self.b.outputs()['data_out']],
+                                gui_thread=True, log=self.log)
+        self.outputNode = PlainNode('output', None,
+                                    [self.b.outputs()['data_out']])
+        self.sigChartChanged = PlainSignal()
+
+    def nodes(self):
+        nodes = [self.inputNode, self.outputNode, self.a, self.b, self.c,
+                 self.view_c, self.view_b]
+        return {node.name: node for node in nodes}
+
+
+@unittest.skipIf(engine is None, 'PyQt5 is not installed')
+class TestFlowchartEngine(unittest.TestCase):
+    """
+    test engine.FlowchartEngine with plain nodes (no pyqtgraph)
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtCore.QCoreApplication.instance() \
+            or QtCore.QCoreApplication([])
+
+    def wait_idle(self, eng, timeout=5.0):
+        # finish() runs on this thread, from the event loop
+        end = time.time() + timeout
+        while eng.jobs != 0 or len(eng.queue) != 0:
+            self.assertLess(time.time(), end, 'engine did not finish')
+            QtCore.QCoreApplication.processEvents()
+            time.sleep(0.001)
+
+    def shown(self, fc, name):
+        return [data for (node, data, display, _) in fc.log
+                if node == name and display]
+
+    def test_plan(self):
+        fc = PlainFlowchart()
+        plan = engine.Plan(fc)
+        self.assertEqual(set(plan.deps), {fc.a, fc.b, fc.c, fc.view_b, fc.view_c})
+        self.assertEqual(plan.deps[fc.a], set())
+        self.assertEqual(plan.deps[fc.c], {fc.a})
+        self.assertEqual(set(plan.dependents[fc.b]), {fc.view_b})
+        self.assertTrue(plan.gui_thread[fc.view_c])
+        self.assertFalse(plan.gui_thread[fc.c])
+        # the snapshot does not follow later changes
+        fc.b.bypassed = True
+        self.assertFalse(plan.bypassed[fc.b])
+        self.assertTrue(engine.Plan(fc).bypassed[fc.b])
+
+    def test_order(self):
+        fc = PlainFlowchart()
+        eng = engine.FlowchartEngine(fc, workers=4)
+        try:
+            eng.submit(import_data=1)
+            self.wait_idle(eng)
+        finally:
+            eng.close()
+        names = [node for (node, _, _, _) in fc.log]
+        self.assertLess(names.index('a'), names.index('c'))
+        self.assertLess(names.index('c'), names.index('view_c'))
+        self.assertEqual(self.shown(fc, 'view_c'), [1])
+        self.assertEqual(self.shown(fc, 'view_b'), [10])
+        # view nodes are processed on the GUI thread
+        for (node, _, _, thread) in fc.log:
+            if node.startswith('view'):
+                self.assertIs(thread, threading.main_thread())
+
+    def test_drop_oldest(self):
+        fc = PlainFlowchart(delay=0.05)
+        eng = engine.FlowchartEngine(fc, max_jobs=1, queue_size=1)
+        try:
+            for i in range(4):
+                eng.submit(import_data=i)
+            self.wait_idle(eng)
+        finally:
+            eng.close()
+        self.assertEqual(eng.dropped, 2)
+        self.assertEqual(self.shown(fc, 'view_b'), [0, 30])
+
+    def test_queue_size(self):
+        fc = PlainFlowchart(delay=0.05)
+        eng = engine.FlowchartEngine(fc, max_jobs=1, queue_size=1)
+        eng.set_queue_size(3)
+        try:
+            for i in range(5):
+                eng.submit(import_data=i)
+            self.wait_idle(eng)
+        finally:
+            eng.close()
+        self.assertEqual(eng.dropped, 1)
+        self.assertEqual(self.shown(fc, 'view_b'), [0, 20, 30, 40])
+
+
+@unittest.skipIf(engine is None, 'PyQt5 is not installed')
+class TestFrameDispatcher(unittest.TestCase):
+    """
+    test engine.FrameDispatcher with plain nodes (no pyqtgraph)
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QtCore.QCoreApplication.instance() \
+            or QtCore.QCoreApplication([])
+
+    def run_dispatcher(self, depth, frames):
+        fc = PlainFlowchart(delay=0.05)
+        eng = engine.FlowchartEngine(fc, max_jobs=1)
+        dispatcher = engine.FrameDispatcher(eng, depth=depth)
+        added = []
+        dispatcher.sigInputAdded.connect(added.append)
+        try:
+            # from another thread, like the UDP importer
+            thread = threading.Thread(
+                target=lambda: [dispatcher.put(f) for f in frames])
+            thread.start()
+            thread.join()
+            end = time.time() + 5.0
+            while eng.jobs != 0 or dispatcher.get_stats()['pending'] != 0:
+                self.assertLess(time.time(), end, 'dispatcher did not finish')
+                QtCore.QCoreApplication.processEvents()
+                time.sleep(0.001)
+        finally:
+            eng.close()
+        return fc, dispatcher, added
+
+    def test_latest(self):
+        frames = [frame.Frame.capture(i) for i in range(5)]
+        fc, dispatcher, added = self.run_dispatcher(1, frames)
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['received'], 5)
+        self.assertEqual(stats['dropped'], 4)
+        self.assertEqual([f.image for (n, f, d, _) in fc.log
+                          if n == 'b'], [4])
+        self.assertIsNotNone(stats['latency'])
+        self.assertEqual(added, ['import_data'])
+
+    def test_depth(self):
+        frames = [frame.Frame.capture(i) for i in range(5)]
+        fc, dispatcher, _ = self.run_dispatcher(3, frames)
+        self.assertEqual(dispatcher.get_stats()['dropped'], 2)
+        self.assertEqual([f.image for (n, f, d, _) in fc.log
+                          if n == 'b'], [2, 3, 4])
+
+    def test_inputs(self):
+        frames = [frame.Frame.capture(0),
+                  frame.Frame.capture(1, input='stream_1')]
+        fc, dispatcher, added = self.run_dispatcher(1, frames)
+        self.assertEqual(added, ['import_data', 'stream_1'])
+        self.assertEqual(dispatcher.values['stream_1'].image, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,7 +1,9 @@
 # coding: utf-8
 
+import os
 import sys
 import time
+import argparse
 import socket
 import struct
 import threading
@@ -11,41 +13,174 @@ import numpy as np
 
 import scapy
 import my_scapy
+import video_source
+
+
+class TokenBucket():
+    """
+    This is Token Bucket
+    送信レートの制限（1トークン = 1バイト）
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate        # [byte/s]
+        self.burst = burst      # [byte]
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def consume(self, size):
+        """
+        take size tokens, returns seconds to wait before sending
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class FrameSource():
+    """
+    This is Frame Source
+    送信する画像（乱数画像、動画ファイル、pcapのリプレイ）
+    """
+    def __init__(self, filename=None):
+        self.video = None
+        self.index = 0
+        if filename is None:
+            return
+        _, ext = os.path.splitext(filename)
+        if ext in {".pcap", ".pcapng"}:
+            self.video = video_source.ListSource(
+                my_scapy.load_pcap_file(filename))
+        else:
+            self.video = video_source.VideoFileSource(filename)
+
+    def read(self):
+        if self.video is None:
+            return self.generate_image()
+        # loop over the file
+        image = None
+        if self.index < len(self.video):
+            image = self.video.get(self.index)
+        if image is None:
+            self.index = 0
+            image = self.video.get(self.index) if len(self.video) else None
+        self.index += 1
+        return image
+
+    def close(self):
+        if self.video is not None:
+            self.video.close()
+
+    def generate_image(self):
+        # generate random input data
+        data = np.random.normal(size=(100,100))
+        data[40:60, 40:60] += 15.0
+        data[30:50, 30:50] += 15.0
+        image = np.zeros(shape=(100,100), dtype=np.uint8)
+        image[:,:] = data[:,:]
+        return image
 
 
 class UdpServer():
     """
     This is UDP Server
     UDP Server は別スレッドで駆動（threading.Thread()）
+
+    frames are sent at fps. within a frame the packets are spaced by a
+    token bucket, at bitrate [bit/s] if given, otherwise so that a frame
+    is spread over spread of the frame period.
     """
-    def __init__(self):
+    # shortest sleep between packets, smaller debts are sent right away
+    min_sleep = 0.001
+
+    def __init__(self, addr=('localhost', my_scapy.VP_PORT), fps=30.0,
+                 bitrate=None, source=None, spread=0.8, report=1.0):
         self.quit_event = threading.Event()
         self.stop_event = threading.Event()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.addr = ('localhost', my_scapy.VP_PORT)
-        self.parser = my_scapy.VideoProtocolParser()
+        self.addr = addr
+        self.parser = my_scapy.VideoProtocolParser(
+            split_size=my_scapy.VP_SPLIT_SIZE)
+        self.fps = fps
+        self.bitrate = bitrate
+        self.spread = spread
+        self.report = report    # seconds between statistics, 0 for none
+        self.source = FrameSource(source)
+        self.stats = dict(frames=0, packets=0, bytes=0, late=0, errors=0)
         self.thread = threading.Thread(target = self.run)
 
-        # self.capture = cv2.VideoCapture(0)
-
         self.stop_event.set()
         self.thread.start()
 
     def run(self):
-        while not self.quit_event.wait(timeout=1.0):
+        period = 1.0 / self.fps
+        next_time = time.monotonic()
+        report_time = next_time
+        last_stats = dict(self.stats)
+        bucket = None
+        while not self.quit_event.is_set():
             if self.stop_event.is_set():
+                # standby
+                self.quit_event.wait(0.1)
+                next_time = time.monotonic()
                 continue
-            image = self.generate_image()
-            if image is None:
+            image = self.source.read()
+            if image is not None:
+                size = image.nbytes
+                if self.bitrate:
+                    rate = self.bitrate / 8.0
+                else:
+                    rate = size * self.fps / self.spread
+                if bucket is None:
+                    bucket = TokenBucket(rate, my_scapy.VP_SPLIT_SIZE * 4)
+                bucket.rate = rate
+                self.send_image(image, bucket)
+
+            now = time.monotonic()
+            if self.report and now - report_time >= self.report:
+                self.print_stats(last_stats, now - report_time)
+                last_stats = dict(self.stats)
+                report_time = now
+            next_time += period
+            if next_time < now:
+                # behind schedule, do not try to catch up
+                self.stats['late'] += 1
+                next_time = now
+            self.quit_event.wait(next_time - now)
+        self.source.close()
+
+    def send_image(self, image, bucket):
+        # headers are packed in place and the image is sent as is
+        for buffers in self.parser.iter_fragments(image):
+            size = sum(len(b) for b in buffers)
+            delay = bucket.consume(size)
+            if delay > self.min_sleep:
+                time.sleep(delay)
+            try:
+                my_scapy.send_fragment(self.sock, self.addr, buffers)
+            except OSError:
+                self.stats['errors'] += 1
                 continue
-            pkts = self.parser.fromimage(image)
-            for pkt in pkts:
-                time.sleep(0.01)
-                buf = scapy.utils.raw(pkt)
-                self.sock.sendto(buf, self.addr)
+            self.stats['packets'] += 1
+            self.stats['bytes'] += size
+        self.stats['frames'] += 1
+
+    def print_stats(self, last, interval):
+        diff = {k: self.stats[k] - last[k] for k in self.stats}
+        print('{0:.1f} fps, {1:.2f} Mbit/s, {2:.0f} packets/s, '
+              'late {3}, errors {4}'.format(
+                  diff['frames'] / interval,
+                  diff['bytes'] * 8 / interval / 1e6,
+                  diff['packets'] / interval,
+                  self.stats['late'], self.stats['errors']))
 
     def quit(self):
         self.quit_event.set()
+        self.stop_event.set()
 
     def stop(self):
         self.stop_event.set()
@@ -53,25 +188,8 @@ class UdpServer():
     def start(self):
         self.stop_event.clear()
 
-    def generate_image(self):
-        # generate random input data
-        data = np.random.normal(size=(100,100))
-        data[40:60, 40:60] += 15.0
-        data[30:50, 30:50] += 15.0
-        image = np.zeros(shape=(100,100), dtype=np.uint8)
-        image[:,:] = data[:,:]
-        return image
-
-        # send camera image
-        # success, image = self.capture.read()
-        # if success:
-        #     return image
-        # else:
-        #     return None
 
-
-
-def loop():
+def loop(server_sock, udp_server):
     while True:
         # クライアントからの接続を待ち受ける (接続されるまでブロックする)
         client_sock, (client_addr, client_port) = server_sock.accept()
@@ -118,28 +236,52 @@ def loop():
         print('Bye-Bye: {0}:{1}'.format(client_addr, client_port))
 
 
-# udp server
-udp_server = UdpServer()
+def main(argv):
+    parser = argparse.ArgumentParser(description='stand-in video camera')
+    parser.add_argument('source', nargs='?', default=None,
+                        help='video or pcap file to replay (default: random images)')
+    parser.add_argument('--fps', type=float, default=30.0,
+                        help='frames per second')
+    parser.add_argument('--bitrate', type=float, default=None,
+                        help='packet pacing [Mbit/s] (default: spread over the frame period)')
+    parser.add_argument('--host', default='localhost',
+                        help='destination host')
+    parser.add_argument('--start', action='store_true',
+                        help='send without waiting for the Running message')
+    args = parser.parse_args(argv)
+
+    # udp server
+    udp_server = UdpServer(
+        addr=(args.host, my_scapy.VP_PORT),
+        fps=args.fps,
+        bitrate=None if args.bitrate is None else args.bitrate * 1e6,
+        source=args.source)
+    if args.start:
+        udp_server.start()
+
+    # IPv4/TCP のソケットを用意する
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    # 'Address already in use' の回避策 (必須ではない)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
 
-# IPv4/TCP のソケットを用意する
-server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # 待ち受けるアドレスとポートを指定する
+    # もし任意のアドレスで Listen したいときは '' を使う
+    host = 'localhost'
+    port = my_scapy.MP_PORT
+    server_sock.bind((host, port))
 
-# 'Address already in use' の回避策 (必須ではない)
-server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+    # クライアントをいくつまでキューイングするか
+    server_sock.listen(1)
 
-# 待ち受けるアドレスとポートを指定する
-# もし任意のアドレスで Listen したいときは '' を使う
-host = 'localhost'
-port = my_scapy.MP_PORT
-server_sock.bind((host, port))
+    try:
+        loop(server_sock, udp_server)
+    except KeyboardInterrupt:
+        print("")
+        print("Ctrl+C is pressed. Now terminating thread. Please Wait...")
+        udp_server.quit()
+        sys.exit()
 
-# クライアントをいくつまでキューイングするか
-server_sock.listen(1)
 
-try:
-    loop()
-except KeyboardInterrupt:
-    print("")
-    print("Ctrl+C is pressed. Now terminating thread. Please Wait...")
-    udp_server.quit()
-    sys.exit()
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Seekable frame sources for FileImporter
+"""
+
+import threading
+import collections
+
+import cv2
+
+
+class ListSource(object):
+    """
+    This is List Source
+    デコード済みフレームのリスト（pcap）
+    """
+    def __init__(self, images):
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, index):
+        return self.images[index]
+
+    def close(self):
+        pass
+
+
+class VideoFileSource(object):
+    """
+    This is Video File Source
+    動画ファイルを必要な分だけデコードするソース
+
+    frames are decoded on demand. a read-ahead thread decodes the frames
+    following the last requested one, and the decoded frames are kept in an
+    LRU cache, so playing, stepping and stepping back near the cursor do not
+    wait for the decoder. other frames are reached with a seek
+    (CAP_PROP_POS_FRAMES).
+    """
+    def __init__(self, filename, cache_size=64, read_ahead=8):
+        self.capture = cv2.VideoCapture(filename)
+        if not self.capture.isOpened():
+            raise IOError('can not open video file: {0}'.format(filename))
+        self.count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.cache_size = max(cache_size, read_ahead + 1)
+        self.read_ahead = read_ahead
+        # cond guards the cache and the cursor, capture_lock the decoder
+        # (the capture is not thread safe). decoding happens outside cond,
+        # so get() of a cached frame never waits for the decoder.
+        self.cache = collections.OrderedDict()  # index -> image
+        self.cond = threading.Condition()
+        self.capture_lock = threading.Lock()
+        self.cursor = 0
+        self.waiting = 0    # get() calls waiting for the decoder
+        self.position = 0   # index of the frame the decoder reads next
+        self.quit = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return self.count
+
+    def get(self, index):
+        """
+        image of frame index, or None past the end of the file
+        """
+        with self.cond:
+            self.cursor = index
+            self.cond.notify()
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+            # the read-ahead thread yields the decoder to us
+            self.waiting += 1
+        try:
+            return self._decode(index)
+        finally:
+            with self.cond:
+                self.waiting -= 1
+                self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.quit = True
+            self.cond.notify()
+        self.thread.join()
+        with self.capture_lock:
+            self.capture.release()
+
+    def _decode(self, index):
+        with self.capture_lock:
+            with self.cond:
+                # decoded by the other thread in the meantime
+                if index in self.cache:
+                    return self.cache[index]
+                if index >= self.count:
+                    return None
+            if index != self.position:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ret, image = self.capture.read()
+            self.position = index + 1 if ret else None
+            with self.cond:
+                if not ret:
+                    # CAP_PROP_FRAME_COUNT is only an estimate for some
+                    # containers
+                    self.count = min(self.count, index)
+                    return None
+                self.cache[index] = image
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return image
+
+    def _next_missing(self):
+        stop = min(self.cursor + 1 + self.read_ahead, self.count)
+        for index in range(self.cursor + 1, stop):
+            if index not in self.cache:
+                return index
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                index = None
+                while not self.quit:
+                    if self.waiting == 0:
+                        index = self._next_missing()
+                        if index is not None:
+                            break
+                    self.cond.wait()
+                if self.quit:
+                    return
+            self._decode(index)